@@ -0,0 +1,165 @@
+''' Free space bitmap used by SmallDisk to hand out and reclaim blocks '''
+import threading
+
+from errno import ENOSPC
+from fuse import FuseOSError
+
+from rwlock import synchronized
+
+
+class BitmapAllocator(object):
+    '''Tracks free blocks with one bit per block, set when the block is in use.
+
+    The bitmap lives in the blocks the superblock gives it and is mirrored
+    in memory, so allocation never has to read the disk. Allocation
+    is next-fit: searches resume from where the last allocation ended.
+
+    Bitmap blocks are shared by every transaction, so they are written from
+    the bits in memory rather than restored when a transaction is abandoned.
+    The blocks it allocated are released instead, and their bits reach the
+    disk with the next write_back. Freed blocks are only released once the
+    transaction freeing them has committed, so until then no other
+    transaction can be handed them or commit a bitmap image with them clear.
+    '''
+
+    def __init__(self, disk, superblock, free_count=None, cursor=0):
+        self.disk = disk
+        self.block_size = superblock.block_size
+        self.num_blocks = superblock.num_blocks
+        self.bitmap_loc = superblock.bitmap_loc
+        self.bitmap_blocks = superblock.bitmap_blocks
+
+        self.bits = bytearray(disk.read_blocks(
+            range(self.bitmap_loc, self.bitmap_loc + self.bitmap_blocks)))
+
+        # counting the set bits is only needed when no checkpoint gave the count
+        if free_count is None:
+            free_count = self.num_blocks - bin(int.from_bytes(self.bits, 'little')).count('1')
+        self.free_count = free_count
+        self.cursor = cursor
+        self.dirty = set()
+        self.lock = threading.RLock()
+
+    def is_free(self, block_num):
+        return not self.bits[block_num >> 3] & (1 << (block_num & 7))
+
+    def mark(self, block_num, used):
+        ''' sets or clears the bit for block_num, remembering which bitmap
+        block now needs writing '''
+        if used:
+            self.bits[block_num >> 3] |= 1 << (block_num & 7)
+        else:
+            self.bits[block_num >> 3] &= ~(1 << (block_num & 7)) & 0xFF
+        self.dirty.add(block_num // (self.block_size * 8))
+
+    def find_run(self, length, start, end):
+        ''' returns the first block of a run of length free blocks between
+        start and end, or None if there is no such run '''
+        run_start = run_length = 0
+        block_num = start
+        while block_num < end:
+            if block_num & 7 == 0 and block_num + 8 <= end:
+                # whole bytes can be skipped or counted at once
+                byte = self.bits[block_num >> 3]
+                if byte == 0xFF:
+                    run_length = 0
+                    block_num += 8
+                    continue
+                if byte == 0:
+                    if run_length == 0:
+                        run_start = block_num
+                    run_length += 8
+                    if run_length >= length:
+                        return run_start
+                    block_num += 8
+                    continue
+
+            if self.is_free(block_num):
+                if run_length == 0:
+                    run_start = block_num
+                run_length += 1
+                if run_length == length:
+                    return run_start
+            else:
+                run_length = 0
+            block_num += 1
+
+        return None
+
+    @synchronized
+    def allocate_extent(self, length):
+        ''' allocates length contiguous blocks, returning the first of them '''
+        if length > self.free_count:
+            raise FuseOSError(ENOSPC)
+
+        start = self.find_run(length, self.cursor, self.num_blocks)
+        if start is None:
+            # wrap around, letting the run overlap the old cursor position
+            start = self.find_run(
+                length, 0, min(self.cursor + length - 1, self.num_blocks))
+        if start is None:
+            raise FuseOSError(ENOSPC)
+
+        for block_num in range(start, start + length):
+            self.mark(block_num, True)
+        self.free_count -= length
+        self.cursor = (start + length) % self.num_blocks
+        self.write_back()
+        self.disk.on_abort(lambda: self.release(range(start, start + length)))
+
+        return start
+
+    @synchronized
+    def allocate(self):
+        ''' allocates a single block '''
+        return self.allocate_extent(1)
+
+    @synchronized
+    def allocate_blocks(self, count):
+        ''' allocates count blocks, contiguously if such a run exists, otherwise
+        in as few runs as the bitmap allows. Returns the block numbers in order.'''
+        if count > self.free_count:
+            raise FuseOSError(ENOSPC)
+        try:
+            start = self.allocate_extent(count)
+            return list(range(start, start + count))
+        except FuseOSError:
+            pass
+
+        block_nums = []
+        length = count
+        while len(block_nums) < count:
+            length = min(length, count - len(block_nums))
+            try:
+                start = self.allocate_extent(length)
+            except FuseOSError:
+                length = max(length // 2, 1)
+                continue
+            block_nums.extend(range(start, start + length))
+
+        return block_nums
+
+    @synchronized
+    def free(self, block_nums):
+        ''' returns all of block_nums to the free space once the current
+        transaction commits '''
+        block_nums = list(block_nums)
+        self.disk.on_commit(lambda: self.release(block_nums))
+
+    @synchronized
+    def release(self, block_nums):
+        ''' clears the bits of block_nums, leaving the bitmap blocks to be
+        written by the next write_back '''
+        for block_num in block_nums:
+            if not self.is_free(block_num):
+                self.mark(block_num, False)
+                self.free_count += 1
+
+    @synchronized
+    def write_back(self):
+        ''' writes the changed bitmap blocks through to the disk '''
+        for i in sorted(self.dirty):
+            self.disk.write_block(
+                self.bitmap_loc + i, self.bits[i * self.block_size:(i + 1) * self.block_size],
+                shared=True)
+        self.dirty.clear()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+''' Benchmarks SmallDisk and Memory by calling their operations directly,
+without mounting them through FUSE.
+
+Each workload runs against a fresh file system: for SmallDisk that is a new
+disk image in a temporary directory. Results are printed as JSON, and
+--compare checks them against the JSON of an earlier run.
+'''
+from __future__ import print_function, absolute_import, division
+
+import json
+import os
+import random
+import sys
+import tempfile
+
+from time import perf_counter
+
+from format import format_disk
+from memory import Memory
+from small import SmallDisk
+from constants import *
+
+
+class Recorder(object):
+    '''Collects the latency and bytes moved by each operation of a workload,
+    and the block I/O the file system did while the workload ran.'''
+
+    def __init__(self, fs):
+        self.fs = fs
+        self.ops = dict()
+        self.io_start = None
+
+    def device(self):
+        disk = getattr(self.fs, 'disk', None)
+        return disk.device if disk is not None else None
+
+    def start(self):
+        ''' marks the end of the workload's setup. Only I/O done after this is
+        counted. '''
+        device = self.device()
+        if device is not None:
+            self.io_start = device.stats()
+
+    def time(self, op, method, *args, **kwargs):
+        ''' calls method, recording its latency under op. Returns its result. '''
+        start = perf_counter()
+        result = method(*args, **kwargs)
+        elapsed = perf_counter() - start
+        latencies, nbytes = self.ops.setdefault(op, ([], [0]))
+        latencies.append(elapsed)
+        if op.startswith('read'):
+            nbytes[0] += len(result)
+        elif op.startswith('write'):
+            nbytes[0] += result
+        return result
+
+    def io(self):
+        device = self.device()
+        if device is None or self.io_start is None:
+            return None
+        return dict((key, value - self.io_start[key])
+                    for key, value in device.stats().items())
+
+    def results(self):
+        results = dict()
+        for op, (latencies, nbytes) in self.ops.items():
+            latencies = sorted(latencies)
+            seconds = sum(latencies)
+            result = dict(count=len(latencies), seconds=seconds,
+                          ops_per_sec=len(latencies) / seconds if seconds else None,
+                          p50_us=percentile(latencies, 50) * 1e6,
+                          p99_us=percentile(latencies, 99) * 1e6)
+            if nbytes[0]:
+                result.update(bytes=nbytes[0],
+                              mb_per_sec=nbytes[0] / seconds / 2**20 if seconds else None)
+            results[op] = result
+        return results
+
+
+def percentile(ordered, pct):
+    ''' nearest-rank percentile of an already sorted list '''
+    rank = max(-(-len(ordered) * pct // 100), 1)
+    return ordered[int(rank) - 1]
+
+
+##### WORKLOADS #####
+# each takes the file system, the recorder, a random generator and the
+# parsed arguments. Setup work is done before calling rec.start().
+
+
+def churn(fs, rec, rng, args):
+    rec.start()
+    for i in range(args.files):
+        path = '/c%d' % i
+        rec.time('create', fs.create, path, 0o644)
+        rec.time('stat', fs.getattr, path)
+    for i in rng.sample(range(args.files), args.files):
+        rec.time('unlink', fs.unlink, '/c%d' % i)
+
+
+def sequential(fs, rec, rng, args):
+    data = payload(rng, args.io_size)
+    rec.start()
+    for size in args.sizes:
+        path = '/s%d' % size
+        fs.create(path, 0o644)
+        for offset in range(0, size, args.io_size):
+            rec.time('write_%d' % size, fs.write, path, data[:size - offset], offset, 0)
+        for offset in range(0, size, args.io_size):
+            rec.time('read_%d' % size, fs.read, path, args.io_size, offset, 0)
+        fs.unlink(path)
+
+
+def random_io(fs, rec, rng, args):
+    data = payload(rng, args.io_size)
+    for size in args.sizes:
+        path = '/r%d' % size
+        fs.create(path, 0o644)
+        fs.write(path, payload(rng, size), 0, 0)
+    rec.start()
+    for size in args.sizes:
+        path = '/r%d' % size
+        chunks = max(size // args.io_size, 1)
+        for _ in range(chunks):
+            offset = rng.randrange(chunks) * args.io_size
+            rec.time('write_%d' % size, fs.write, path, data[:size - offset], offset, 0)
+        for _ in range(chunks):
+            offset = rng.randrange(chunks) * args.io_size
+            rec.time('read_%d' % size, fs.read, path, args.io_size, offset, 0)
+
+
+def readdir(fs, rec, rng, args):
+    for i in range(args.files):
+        fs.create('/d%d' % i, 0o644)
+    rec.start()
+    for _ in range(args.rounds):
+        rec.time('readdir', fs.readdir, '/', 0)
+
+
+def truncate(fs, rec, rng, args):
+    size = max(args.sizes)
+    for i in range(args.rounds):
+        fs.create('/t%d' % i, 0o644)
+    rec.start()
+    for i in range(args.rounds):
+        path = '/t%d' % i
+        rec.time('extend', fs.truncate, path, size)
+        rec.time('shrink', fs.truncate, path, size // 2)
+        rec.time('empty', fs.truncate, path, 0)
+
+
+WORKLOADS = dict(churn=churn, sequential=sequential, random=random_io,
+                 readdir=readdir, truncate=truncate)
+
+
+def payload(rng, size):
+    return bytes(rng.getrandbits(8) for _ in range(size))
+
+
+##### RUNNING #####
+
+
+def run_workload(target, workload, args):
+    rng = random.Random(args.seed)
+    if target == 'memory':
+        fs = Memory()
+        rec = Recorder(fs)
+        WORKLOADS[workload](fs, rec, rng, args)
+        return dict(ops=rec.results(), io=None)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        disk_name = os.path.join(tmp, DISK_NAME)
+        format_disk(disk_name, args.block_size, args.num_blocks)
+        fs = SmallDisk(disk_name, 'mmap' if args.mmap else 'pread', args.cache_size)
+        rec = Recorder(fs)
+        try:
+            WORKLOADS[workload](fs, rec, rng, args)
+            cache = fs.disk.stats()
+        finally:
+            # unmounting writes back what the workload left in the cache,
+            # which counts towards its block I/O
+            fs.destroy('/')
+        return dict(ops=rec.results(), io=rec.io(), cache=cache)
+
+
+def run(args):
+    results = dict()
+    for target in args.targets:
+        results[target] = dict((workload, run_workload(target, workload, args))
+                               for workload in args.workloads)
+    config = dict((key, getattr(args, key)) for key in
+                  ('files', 'rounds', 'sizes', 'io_size', 'block_size', 'num_blocks',
+                   'cache_size', 'mmap', 'seed'))
+    return dict(config=config, results=results)
+
+
+def compare(baseline, current, threshold):
+    ''' prints the change in throughput of every operation found in both
+    runs. Returns the number of operations which slowed down by more than
+    threshold percent. '''
+    regressions = 0
+    for target, workloads in sorted(current['results'].items()):
+        for workload, result in sorted(workloads.items()):
+            base = baseline['results'].get(target, {}).get(workload)
+            if base is None:
+                continue
+            for op, stats in sorted(result['ops'].items()):
+                before = base['ops'].get(op, {}).get('ops_per_sec')
+                after = stats['ops_per_sec']
+                if not before or not after:
+                    continue
+                change = (after - before) / before * 100
+                flag = ''
+                if change < -threshold:
+                    regressions += 1
+                    flag = '  REGRESSION'
+                print('%-7s %-10s %-14s %12.1f -> %12.1f ops/s %+7.1f%%%s'
+                      % (target, workload, op, before, after, change, flag),
+                      file=sys.stderr)
+    return regressions
+
+
+def sizes(text):
+    return [int(size) for size in text.split(',')]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--targets', nargs='+', choices=('small', 'memory'),
+                        default=['small', 'memory'])
+    parser.add_argument('--workloads', nargs='+', choices=sorted(WORKLOADS),
+                        default=sorted(WORKLOADS))
+    parser.add_argument('--files', type=int, default=500,
+                        help='files created by the churn and readdir workloads')
+    parser.add_argument('--rounds', type=int, default=20,
+                        help='repetitions of the readdir and truncate workloads')
+    parser.add_argument('--sizes', type=sizes, default=[4096, 65536, 1048576],
+                        help='comma separated file sizes for the read/write workloads')
+    parser.add_argument('--io-size', type=int, default=4096,
+                        help='bytes moved by each read or write call')
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument('--num-blocks', type=int, default=DEFAULT_NUM_BLOCKS)
+    parser.add_argument('--cache-size', type=int, default=CACHE_BLOCKS)
+    parser.add_argument('--mmap', action='store_true')
+    parser.add_argument('--seed', type=int, default=370)
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='percent slowdown reported as a regression by --compare')
+    args = parser.parse_args()
+
+    current = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    else:
+        json.dump(current, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        sys.exit(1 if compare(baseline, current, args.threshold) else 0)
@@ -0,0 +1,217 @@
+''' Write-back block cache which sits between SmallDisk and the BlockDevice '''
+import threading
+
+from collections import OrderedDict
+
+from constants import CACHE_BLOCKS
+from rwlock import synchronized
+
+
+class BlockCache(object):
+    '''Keeps up to size blocks in memory, evicting the least recently used.
+
+    Writes only update the cached copy and mark it dirty. Dirty blocks reach
+    the device when they are evicted, or when flush/sync/close is called.
+    Pinned blocks, which the journal has not yet committed, stay in memory
+    and are not written back until they are unpinned.
+    Offers the same read_block/view_block/write_block interface as BlockDevice.
+
+    Every method holds the cache lock, except that large reads fetch their
+    misses from the device without it. Cached blocks are replaced rather
+    than changed in place, so a view stays valid after the lock is released.
+    '''
+
+    def __init__(self, device, size=CACHE_BLOCKS):
+        if size < 1:
+            raise ValueError('Block cache needs room for at least one block')
+        self.device = device
+        self.superblock = device.superblock
+        self.block_size = device.block_size
+        self.num_blocks = device.num_blocks
+        self.size = size
+        self.blocks = OrderedDict()
+        self.dirty = set()
+        self.pinned = dict()
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.writebacks = 0
+
+    @synchronized
+    def get(self, block_num):
+        ''' returns the cached bytearray for block_num, loading it on a miss'''
+        block = self.blocks.get(block_num)
+        if block is not None:
+            self.hits += 1
+            self.blocks.move_to_end(block_num)
+            return block
+
+        self.misses += 1
+        block = self.device.read_block(block_num)
+        self.insert(block_num, block)
+        return block
+
+    @synchronized
+    def insert(self, block_num, block):
+        self.blocks[block_num] = block
+        self.blocks.move_to_end(block_num)
+        while len(self.blocks) > self.size:
+            if not self.evict():
+                break
+
+    def evict(self):
+        ''' drops the least recently used block which is not pinned, writing
+        it back first if it is dirty. Returns False if every block is pinned.'''
+        for block_num in self.blocks:
+            if block_num not in self.pinned:
+                break
+        else:
+            return False
+
+        block = self.blocks.pop(block_num)
+        if block_num in self.dirty:
+            self.device.write_block(block_num, block)
+            self.dirty.discard(block_num)
+            self.writebacks += 1
+        return True
+
+    @synchronized
+    def pin(self, block_nums):
+        for block_num in block_nums:
+            self.pinned[block_num] = self.pinned.get(block_num, 0) + 1
+
+    @synchronized
+    def pinned_blocks(self, block_nums):
+        ''' returns those of block_nums which are pinned'''
+        return [block_num for block_num in block_nums if block_num in self.pinned]
+
+    @synchronized
+    def unpin(self, block_nums):
+        for block_num in block_nums:
+            self.pinned[block_num] -= 1
+            if not self.pinned[block_num]:
+                del self.pinned[block_num]
+        while len(self.blocks) > self.size:
+            if not self.evict():
+                break
+
+    @synchronized
+    def peek_block(self, block_num):
+        ''' returns a copy of block_num if it is cached, otherwise None. The
+        device is not read.'''
+        block = self.blocks.get(block_num)
+        return None if block is None else bytes(block)
+
+    @synchronized
+    def discard(self, block_nums):
+        ''' drops the cached copies of block_nums without writing them back,
+        so they are read from the device again'''
+        for block_num in block_nums:
+            self.blocks.pop(block_num, None)
+            self.dirty.discard(block_num)
+
+    @synchronized
+    def view_block(self, block_num):
+        '''Returns a read-only view of the cached block without copying it.'''
+        return memoryview(self.get(block_num)).toreadonly()
+
+    @synchronized
+    def read_block(self, block_num):
+        '''Returns a private copy of block_num which the caller may modify.'''
+        return bytearray(self.get(block_num))
+
+    @synchronized
+    def write_block(self, block_num, data):
+        '''Overwrites the start of block_num with data. Like the device, a
+        short write leaves the rest of the block as it was.'''
+        self.device.check_block_num(block_num)
+        if len(data) < self.block_size:
+            block = bytearray(self.get(block_num))
+            block[:len(data)] = data
+        else:
+            block = bytearray(data)
+        self.dirty.add(block_num)
+        self.insert(block_num, block)
+
+    def read_blocks(self, block_nums, buffer=None):
+        '''Reads every block in block_nums into buffer, as BlockDevice.read_blocks
+        does. Cached blocks are copied from memory and the rest are fetched
+        from the device in one coalesced call, without holding the lock. Large
+        reads are not kept, so streaming a file does not push everything else
+        out of the cache.'''
+        if buffer is None:
+            buffer = bytearray(len(block_nums) * self.block_size)
+        view = memoryview(buffer)
+
+        missing = []
+        with self.lock:
+            for position, block_num in enumerate(block_nums):
+                block = self.blocks.get(block_num)
+                if block is None:
+                    missing.append((position, block_num))
+                else:
+                    self.hits += 1
+                    self.blocks.move_to_end(block_num)
+                    view[position * self.block_size:(position + 1) * self.block_size] = block
+            self.misses += len(missing)
+
+        if missing:
+            fetched = self.device.read_blocks([block_num for _, block_num in missing])
+            keep = len(missing) <= self.size // 2
+            with self.lock:
+                for i, (position, block_num) in enumerate(missing):
+                    block = self.blocks.get(block_num)
+                    if block is None:
+                        block = fetched[i * self.block_size:(i + 1) * self.block_size]
+                        if keep:
+                            self.insert(block_num, block)
+                    view[position * self.block_size:(position + 1) * self.block_size] = block
+
+        return buffer
+
+    def write_blocks(self, blocks):
+        '''Writes a dictionary of block_num: whole block data. Small batches are
+        cached as dirty blocks like write_block. Large ones update any cached
+        copies, then are written straight through to the device in one
+        coalesced call, without holding the lock.'''
+        with self.lock:
+            if len(blocks) <= self.size // 2:
+                for block_num, data in blocks.items():
+                    self.device.check_block_num(block_num)
+                    self.dirty.add(block_num)
+                    self.insert(block_num, bytearray(data))
+                return
+
+            for block_num, data in blocks.items():
+                if block_num in self.blocks:
+                    self.blocks[block_num] = bytearray(data)
+                    self.dirty.discard(block_num)
+
+        self.device.write_blocks(blocks)
+
+    @synchronized
+    def flush(self):
+        '''Writes every dirty block which is not pinned back to the device,
+        coalescing runs of adjacent blocks into single writes.'''
+        flushed = [block_num for block_num in self.dirty if block_num not in self.pinned]
+        self.device.write_blocks(dict((block_num, self.blocks[block_num])
+                                      for block_num in flushed))
+        self.writebacks += len(flushed)
+        self.dirty.difference_update(flushed)
+
+    @synchronized
+    def sync(self):
+        self.flush()
+        self.device.sync()
+
+    @synchronized
+    def close(self):
+        self.flush()
+        self.device.close()
+
+    @synchronized
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    writebacks=self.writebacks, cached=len(self.blocks),
+                    dirty=len(self.dirty))
@@ -0,0 +1,108 @@
+''' Snapshot of SmallDisk's in-memory metadata, written at a clean unmount '''
+import zlib
+
+from codec import CHECKPOINT_HEADER, CHECKPOINT_ENTRY, DIRENT, EXTENT, BLOCK_PTR
+from dirents import Directory
+from extents import ExtentMap
+from format import bytes_to_pathname, path_name_as_bytes
+from constants import *
+
+
+class Checkpoint(object):
+    '''The state SmallDisk would otherwise rebuild by reading the disk: the
+    free block count and allocation cursor, and the entries and extent map
+    of each directory it had loaded.
+
+    It is written to the checkpoint region after the journal has been
+    emptied at unmount, tagged with the sequence number of the journal
+    marker written then. Any later mount or journal checkpoint writes a
+    marker with a higher sequence number, so a checkpoint is only loaded
+    if nothing has changed on the disk since it was written.
+    '''
+
+    def __init__(self, free_count, cursor, directories=None, extent_maps=None):
+        self.free_count = free_count
+        self.cursor = cursor
+        self.directories = directories or dict()
+        self.extent_maps = extent_maps or dict()
+
+    def pack(self, capacity):
+        ''' returns the entries as bytes, and how many of them fit in capacity
+        bytes. Directories which do not fit are left to load from the disk.'''
+        body = bytearray()
+        count = 0
+        for dir_num, directory in self.directories.items():
+            extent_map = self.extent_maps[dir_num]
+            entry = bytearray(CHECKPOINT_ENTRY.size)
+            CHECKPOINT_ENTRY.pack_into(entry, file_num=dir_num, count=len(directory),
+                                       extent_count=len(extent_map.extents),
+                                       map_count=len(extent_map.map_blocks))
+            entry += b''.join(DIRENT.pack(path_name_as_bytes(name), directory.get(name))
+                              for name in directory.names)
+            entry += b''.join(EXTENT.pack(*extent) for extent in extent_map.extents)
+            entry += b''.join(BLOCK_PTR.pack(map_num) for map_num in extent_map.map_blocks)
+            if len(body) + len(entry) > capacity:
+                break
+            body += entry
+            count += 1
+        return bytes(body), count
+
+    @classmethod
+    def unpack(cls, header, body):
+        ''' decodes the entries in body, which the header has been checked against'''
+        directories = dict()
+        extent_maps = dict()
+        body = memoryview(body)
+        loc = 0
+        for _ in range(header['directories']):
+            entry = CHECKPOINT_ENTRY.unpack(body[loc:loc + CHECKPOINT_ENTRY.size])
+            loc += CHECKPOINT_ENTRY.size
+            end = loc + entry['count'] * DIRENT.size
+            directories[entry['file_num']] = Directory(
+                (bytes_to_pathname(name), file_num)
+                for name, file_num in DIRENT.iter_unpack(body[loc:end]))
+            loc, end = end, end + entry['extent_count'] * EXTENT.size
+            extents = EXTENT.iter_unpack(body[loc:end])
+            loc, end = end, end + entry['map_count'] * BLOCK_PTR.size
+            map_blocks = [map_num for map_num, in BLOCK_PTR.iter_unpack(body[loc:end])]
+            extent_maps[entry['file_num']] = ExtentMap(extents, map_blocks)
+            loc = end
+        return cls(header['free_count'], header['cursor'], directories, extent_maps)
+
+    def write(self, device, generation):
+        ''' writes the checkpoint region straight to the device, in one request'''
+        sb = device.superblock
+        body, count = self.pack(sb.checkpoint_blocks * sb.block_size - CHECKPOINT_HEADER.size)
+        data = bytearray(CHECKPOINT_HEADER.size)
+        CHECKPOINT_HEADER.pack_into(data, magic=CHECKPOINT_MAGIC, generation=generation,
+                                    length=len(body), checksum=zlib.crc32(body),
+                                    free_count=self.free_count, cursor=self.cursor,
+                                    directories=count)
+        data += body
+        data += bytes(-len(data) % sb.block_size)
+        device.write_blocks(dict(
+            (sb.checkpoint_loc + i, data[i * sb.block_size:(i + 1) * sb.block_size])
+            for i in range(len(data) // sb.block_size)))
+        device.sync()
+
+    @classmethod
+    def read(cls, device, generation):
+        ''' returns the checkpoint in the region if it was written with
+        generation and is intact, otherwise None'''
+        sb = device.superblock
+        first = device.read_block(sb.checkpoint_loc)
+        header = CHECKPOINT_HEADER.unpack(first)
+        if header['magic'] != CHECKPOINT_MAGIC or header['generation'] != generation:
+            return None
+        size = CHECKPOINT_HEADER.size + header['length']
+        if size > sb.checkpoint_blocks * sb.block_size:
+            return None
+
+        data = bytes(first)
+        if size > sb.block_size:
+            data += bytes(device.read_blocks(
+                range(sb.checkpoint_loc + 1, sb.checkpoint_loc + -(-size // sb.block_size))))
+        body = data[CHECKPOINT_HEADER.size:size]
+        if zlib.crc32(body) != header['checksum']:
+            return None
+        return cls.unpack(header, body)
@@ -0,0 +1,84 @@
+''' Precompiled struct codecs for the records stored in blocks '''
+import struct
+
+from constants import *
+
+
+class Record(object):
+    '''Packs and unpacks a record laid out by a schema of (name, format) pairs.
+
+    The whole record and each of its fields get a precompiled struct.Struct,
+    so a record can be decoded in one call, and a single field can be read
+    or updated in place with unpack_from/pack_into on a block or memoryview.
+    '''
+
+    def __init__(self, schema, offset=0):
+        self.names = tuple(name for name, _ in schema)
+        self.struct = struct.Struct('>' + ''.join(fmt for _, fmt in schema))
+        self.offset = offset
+        self.size = self.struct.size
+        self.end = offset + self.size
+
+        self.fields = dict()
+        loc = offset
+        for name, fmt in schema:
+            field = struct.Struct('>' + fmt)
+            self.fields[name] = (loc, field)
+            loc += field.size
+
+    def loc(self, name):
+        ''' returns the offset of field name within the block'''
+        return self.fields[name][0]
+
+    def unpack(self, block):
+        ''' returns every field of the record in block as a dictionary'''
+        return dict(zip(self.names, self.struct.unpack_from(block, self.offset)))
+
+    def pack_into(self, block, **values):
+        ''' writes every field of the record into block'''
+        self.struct.pack_into(block, self.offset, *[values[name] for name in self.names])
+
+    def get(self, block, name):
+        loc, field = self.fields[name]
+        return field.unpack_from(block, loc)[0]
+
+    def set(self, block, name, value):
+        loc, field = self.fields[name]
+        field.pack_into(block, loc, value)
+
+
+SUPERBLOCK = Record(SUPERBLOCK_SCHEMA, SUPERBLOCK_LOC)
+METADATA = Record(METADATA_SCHEMA)
+# the stats on their own, decoded straight out of a metadata block
+STAT = Record(STAT_SCHEMA, METADATA.loc('st_mode'))
+MAP_HEADER = Record(MAP_HEADER_SCHEMA)
+JOURNAL_HEADER = Record(JOURNAL_HEADER_SCHEMA)
+CHECKPOINT_HEADER = Record(CHECKPOINT_HEADER_SCHEMA)
+CHECKPOINT_ENTRY = Record(CHECKPOINT_ENTRY_SCHEMA)
+BLOCK_PTR = struct.Struct('>' + BLOCK_PTR_FORMAT)
+EXTENT = struct.Struct('>' + ''.join(fmt for _, fmt in EXTENT_SCHEMA))
+DIRENT = struct.Struct('>' + ''.join(fmt for _, fmt in DIRENT_SCHEMA))
+
+# where the extents start in a metadata block, and in a map block
+EXTENT_LOC = METADATA.end
+MAP_EXTENT_LOC = MAP_HEADER.end
+# an inline file's data takes the place of the extents
+INLINE_DATA_LOC = METADATA.end
+
+
+def pack_extents_into(block, loc, extents):
+    ''' writes (start, length) pairs for each extent into block from loc'''
+    for start, length in extents:
+        EXTENT.pack_into(block, loc, start, length)
+        loc += EXTENT.size
+
+
+def unpack_extents(block, loc, count):
+    ''' reads count extents from block, starting at loc'''
+    return [list(extent) for extent in
+            EXTENT.iter_unpack(block[loc:loc + count * EXTENT.size])]
+
+
+def unpack_dirents(block, count):
+    '''reads the first count directory entries in block as (name, file_num)'''
+    return DIRENT.iter_unpack(block[:count * DIRENT.size])
@@ -1,44 +1,151 @@
 ''' Stores the constants used by small and format'''
 
-# BLOCK & DISK CONSTANTS
-NUM_BLOCKS = 16
-BLOCK_SIZE = 64
+# DEFAULT GEOMETRY, used when formatting a new disk. A formatted disk
+# records its own geometry in its superblock, which is what SmallDisk uses.
+DEFAULT_NUM_BLOCKS = 4096
+DEFAULT_BLOCK_SIZE = 4096
+MIN_BLOCK_SIZE = 64
 DISK_NAME = 'my-disk'
-ROOT_LOC = 0
-
-# FILE METADATA SIZES
-NEXT_FILE_SIZE = 1
-NEXT_BLOCK_SIZE = 1
-FILE_DATA_SIZE = 37
-
-# EFFECTIVE SIZE
-EFFECTIVE_BLOCK_SIZE = BLOCK_SIZE - NEXT_BLOCK_SIZE - NEXT_FILE_SIZE
-
-# FILE METADATA LOCATIONS
-NEXT_FILE_LOC = 0
-NEXT_BLOCK_LOC = 1
-FILE_DATA_LOC = 2
-
-# STATS SIZE CONSTANTS
-ST_MODE_SIZE = 2
-ST_UID_SIZE = 2
-ST_GID_SIZE = 2
-ST_NLINKS_SIZE = 1
-ST_SIZE_SIZE = 2
-ST_CTIME_SIZE = 4
-ST_MTIME_SIZE = 4
-ST_ATIME_SIZE = 4
+
+# SUPERBLOCK, stored in block 0
+SUPERBLOCK_LOC = 0
+FORMAT_MAGIC = b'SMALLFS\x00'
+FORMAT_VERSION = 8
+
+# METADATA JOURNAL, between the bitmap and the root. Block 0 of the journal
+# holds a marker record, and committed transactions are appended after it.
+DEFAULT_JOURNAL_BLOCKS = 256
+# a record must hold the blocks one operation changes, and the journal at
+# least two such records after its marker
+MIN_JOURNAL_RECORD_BLOCKS = 8
+MIN_JOURNAL_BLOCKS = 1 + 2 * (1 + MIN_JOURNAL_RECORD_BLOCKS)
+JOURNAL_MAGIC = b'JRNL'
+
+# METADATA CHECKPOINT, between the journal and the root. Written at a clean
+# unmount with the directories SmallDisk has loaded and the free space
+# count, and only trusted at mount if its generation matches the journal
+# marker, which every later mount or journal checkpoint moves on.
+DEFAULT_CHECKPOINT_BLOCKS = 64
+CHECKPOINT_MAGIC = b'CKPT'
+
+# BLOCK CACHE
+CACHE_BLOCKS = 256
+
+# READ-AHEAD. The window of blocks fetched past a sequential read starts at
+# the minimum and doubles with each further sequential read, up to the
+# maximum. Only the most recently read files keep a read-ahead buffer.
+READAHEAD_MIN_BLOCKS = 4
+READAHEAD_MAX_BLOCKS = 64
+READAHEAD_STREAMS = 16
+
+# TIMESTAMPS. With relatime, a read updates the access time if it is older
+# than RELATIME_SECONDS even if the file has not changed. With lazytime,
+# timestamp changes are held in memory and written back every
+# TIMESTAMP_FLUSH_SECONDS, and at flush, fsync and unmount.
+RELATIME_SECONDS = 24 * 60 * 60
+TIMESTAMP_FLUSH_SECONDS = 30
+
+# I/O ENGINE. Requests covering several runs of blocks are issued on a pool
+# of threads, each run split into pieces of at most IO_CHUNK_BLOCKS, with no
+# more than IO_MAX_IN_FLIGHT outstanding at once.
+IO_THREADS = 4
+IO_MAX_IN_FLIGHT = 16
+IO_CHUNK_BLOCKS = 32
+
+# BLOCK POINTERS. The largest pointer value is used to indicate no block.
+BLOCK_PTR_FORMAT = 'I'
+BLOCK_PTR_SIZE = 4
+NO_BLOCK = 2 ** (8 * BLOCK_PTR_SIZE) - 1
+
 NAME_SIZE = 16
 
-# STATS LOCATION CONSTANTS
-MTIME_LOC = 13 + FILE_DATA_LOC
-ATIME_LOC = 17 + FILE_DATA_LOC
-NAME_LOC = FILE_DATA_LOC + FILE_DATA_SIZE - NAME_SIZE
-ST_SIZE_LOC = 7
-ST_N_LINKS_LOC = FILE_DATA_LOC + 6
+# RECORD SCHEMAS. Each record is a list of (name, struct format) fields,
+# packed big-endian with no padding. These are the only description of the
+# on-disk layout, codec builds the packers and field offsets from them.
+# locations are block pointers, so that the superblock still fits in the
+# smallest block now that it records the checkpoint region as well
+SUPERBLOCK_SCHEMA = (
+    ('magic', '%ds' % len(FORMAT_MAGIC)),
+    ('version', 'I'),
+    ('block_size', 'I'),
+    ('num_blocks', 'Q'),
+    ('bitmap_loc', BLOCK_PTR_FORMAT),
+    ('bitmap_blocks', 'I'),
+    ('journal_loc', BLOCK_PTR_FORMAT),
+    ('journal_blocks', 'I'),
+    ('checkpoint_loc', BLOCK_PTR_FORMAT),
+    ('checkpoint_blocks', 'I'),
+    ('root_loc', BLOCK_PTR_FORMAT))
+
+# the stats returned by getattr, in the order they are stored
+STAT_SCHEMA = (
+    ('st_mode', 'H'),
+    ('st_uid', 'H'),
+    ('st_gid', 'H'),
+    ('st_nlink', 'B'),
+    ('st_size', 'Q'),
+    ('st_ctime', 'I'),
+    ('st_mtime', 'I'),
+    ('st_atime', 'I'))
+
+# start of every file's metadata block. next_block points to the first map
+# block, and fh is only used by the root. name is the last component of the
+# file's path, and next_file is always NO_BLOCK now that directories list
+# their children. The first extents follow directly, or with INLINE_DATA set
+# in flags, the file's data itself.
+METADATA_SCHEMA = (
+    ('next_file', BLOCK_PTR_FORMAT),
+    ('next_block', BLOCK_PTR_FORMAT)) + STAT_SCHEMA + (
+    ('name', '%ds' % NAME_SIZE),
+    ('fh', 'I'),
+    ('extent_count', 'I'),
+    ('flags', 'B'))
+
+# METADATA FLAGS. A regular file small enough to fit in the rest of its
+# metadata block keeps its data there, and has no extents or data blocks.
+INLINE_DATA = 0x01
+
+# start of every map block, followed by the extents it holds
+MAP_HEADER_SCHEMA = (
+    ('next_file', BLOCK_PTR_FORMAT),
+    ('next_block', BLOCK_PTR_FORMAT),
+    ('extent_count', 'I'))
+
+EXTENT_SCHEMA = (
+    ('start', BLOCK_PTR_FORMAT),
+    ('length', 'I'))
+
+# a directory's data blocks hold one entry per child, naming it and giving
+# the block holding its metadata. Entries never straddle two blocks.
+DIRENT_SCHEMA = (
+    ('name', '%ds' % NAME_SIZE),
+    ('file_num', BLOCK_PTR_FORMAT))
+
+# start of each journal record. The block numbers of the images follow, then
+# the images themselves fill the next count blocks. A marker record has no
+# images. checksum covers the block numbers and the images.
+JOURNAL_HEADER_SCHEMA = (
+    ('magic', '%ds' % len(JOURNAL_MAGIC)),
+    ('sequence', 'Q'),
+    ('count', 'I'),
+    ('checksum', 'I'))
 
-# ROOT METADATA SIZES
-FH_SIZE = 1
+# start of the checkpoint region. length bytes of entries follow the header,
+# and checksum covers them. Each entry gives a directory's metadata block, its
+# entries and its extent map.
+CHECKPOINT_HEADER_SCHEMA = (
+    ('magic', '%ds' % len(CHECKPOINT_MAGIC)),
+    ('generation', 'Q'),
+    ('length', 'Q'),
+    ('checksum', 'I'),
+    ('free_count', 'Q'),
+    ('cursor', 'Q'),
+    ('directories', 'I'))
 
-# ROOT METADATA LOCATIONS
-FH_LOC = 39
+# followed by count directory entries, extent_count extents, then the block
+# numbers of map_count map blocks
+CHECKPOINT_ENTRY_SCHEMA = (
+    ('file_num', BLOCK_PTR_FORMAT),
+    ('count', 'I'),
+    ('extent_count', 'I'),
+    ('map_count', 'I'))
@@ -0,0 +1,48 @@
+''' Names and metadata blocks of the children of a directory '''
+
+
+class Directory(object):
+    '''A directory's entries, in the order they are stored in its data blocks.
+
+    names[i] is the name in entry i, and children maps each name to the block
+    holding that child's metadata. Removing an entry moves the last entry
+    into its place, so the entries stay packed from the start and emptied
+    blocks are always at the end.
+    '''
+
+    def __init__(self, entries=()):
+        self.names = []
+        self.children = dict()
+        self.slots = dict()
+        for name, file_num in entries:
+            self.add(name, file_num)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.children
+
+    def get(self, name):
+        return self.children.get(name)
+
+    def add(self, name, file_num):
+        ''' appends an entry, returning its slot'''
+        slot = len(self.names)
+        self.names.append(name)
+        self.children[name] = file_num
+        self.slots[name] = slot
+        return slot
+
+    def remove(self, name):
+        ''' removes the entry for name. Returns its slot, and the name of the
+        entry moved into that slot, or None if it was the last entry'''
+        slot = self.slots.pop(name)
+        del self.children[name]
+        last = self.names.pop()
+        if slot == len(self.names):
+            return slot, None
+
+        self.names[slot] = last
+        self.slots[last] = slot
+        return slot, last
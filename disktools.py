@@ -1,38 +1,285 @@
 from __future__ import print_function, division
 import io
+import mmap
 import os
 
-NUM_BLOCKS = 16
-BLOCK_SIZE = 64
-DISK_NAME = 'my-disk'
+from codec import SUPERBLOCK
+from constants import *
+from ioengine import IOEngine
 
-def low_level_format():
-    '''Creates the file system space on disk.
+def low_level_format(num_blocks=DEFAULT_NUM_BLOCKS, block_size=DEFAULT_BLOCK_SIZE,
+                     disk_name=DISK_NAME):
+    '''Creates the file system space on disk, as a sparse file of zeros which
+    takes no space until blocks are written.
         Warning: calling this erases any existing data in the file system.
     '''
-    with open(DISK_NAME, 'w+b') as disk:
-        for i in range(NUM_BLOCKS):
-            block = bytearray([0] * BLOCK_SIZE)
-            disk.write(block)
-        disk.flush()
+    with open(disk_name, 'w+b') as disk:
+        disk.truncate(num_blocks * block_size)
 
 def read_block(block_num):
     '''Reads block_num block from the file system.
-        Return: a bytearray of BLOCK_SIZE
+        Return: a bytearray of the disk's block size
     '''
-    if block_num >= NUM_BLOCKS:
-        raise IOError('Block number out of range')
-    with open(DISK_NAME, 'rb') as disk:
-        disk.seek(block_num * BLOCK_SIZE)
-        return bytearray(disk.read(BLOCK_SIZE))  # .encode())
+    with BlockDevice(DISK_NAME) as disk:
+        return disk.read_block(block_num)
 
 def write_block(block_num, data):
     '''Writes data to the block_num block.'''
-    if block_num >= NUM_BLOCKS:
-        raise IOError('Block number out of range')
-    with open(DISK_NAME, 'r+b') as disk:
-        disk.seek(block_num * BLOCK_SIZE)
-        disk.write(data)
+    with BlockDevice(DISK_NAME) as disk:
+        disk.write_block(block_num, data)
+
+
+class Superblock(object):
+    '''The geometry of a formatted disk, kept at the start of block 0.
+
+    The free space bitmap follows the superblock, then the metadata journal,
+    the metadata checkpoint and the root directory.
+    '''
+
+    SIZE = SUPERBLOCK.end
+
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE, num_blocks=DEFAULT_NUM_BLOCKS,
+                 version=FORMAT_VERSION, bitmap_loc=None, bitmap_blocks=None,
+                 journal_loc=None, journal_blocks=None, checkpoint_loc=None,
+                 checkpoint_blocks=None, root_loc=None):
+        if block_size < MIN_BLOCK_SIZE:
+            raise ValueError('Block size must be at least ' + str(MIN_BLOCK_SIZE))
+        if num_blocks >= NO_BLOCK:
+            raise ValueError('Too many blocks for ' + str(BLOCK_PTR_SIZE) + ' byte block pointers')
+
+        self.version = version
+        self.block_size = block_size
+        self.num_blocks = num_blocks
+        self.bitmap_loc = SUPERBLOCK_LOC + 1 if bitmap_loc is None else bitmap_loc
+        self.bitmap_blocks = -(-num_blocks // (block_size * 8)) \
+            if bitmap_blocks is None else bitmap_blocks
+        self.journal_loc = self.bitmap_loc + self.bitmap_blocks \
+            if journal_loc is None else journal_loc
+        self.journal_blocks = min(DEFAULT_JOURNAL_BLOCKS, max(num_blocks // 16, MIN_JOURNAL_BLOCKS)) \
+            if journal_blocks is None else journal_blocks
+        if self.journal_blocks < MIN_JOURNAL_BLOCKS:
+            raise ValueError('Journal must be at least ' + str(MIN_JOURNAL_BLOCKS) + ' blocks')
+        self.checkpoint_loc = self.journal_loc + self.journal_blocks \
+            if checkpoint_loc is None else checkpoint_loc
+        self.checkpoint_blocks = min(DEFAULT_CHECKPOINT_BLOCKS, max(num_blocks // 64, 1)) \
+            if checkpoint_blocks is None else checkpoint_blocks
+        self.root_loc = self.checkpoint_loc + self.checkpoint_blocks \
+            if root_loc is None else root_loc
+        if num_blocks <= self.root_loc + 1:
+            raise ValueError('Too few blocks: ' + str(num_blocks) + ' leaves no room after the '
+                             'root directory at block ' + str(self.root_loc))
+
+    def pack(self):
+        ''' returns the superblock as a whole block of bytes'''
+        data = bytearray(self.block_size)
+        SUPERBLOCK.pack_into(data, magic=FORMAT_MAGIC, **vars(self))
+        return data
+
+    @classmethod
+    def unpack(cls, data):
+        if len(data) < cls.SIZE or SUPERBLOCK.get(data, 'magic') != FORMAT_MAGIC:
+            raise IOError('Disk image has not been formatted')
+
+        values = SUPERBLOCK.unpack(data)
+        del values['magic']
+        if values['version'] != FORMAT_VERSION:
+            raise IOError('Unsupported disk format version ' + str(values['version']))
+        return cls(**values)
+
+    @classmethod
+    def read(cls, fd):
+        ''' reads the superblock from an open disk image'''
+        return cls.unpack(os.pread(fd, cls.SIZE, SUPERBLOCK_LOC))
+
+
+class BlockDevice(object):
+    '''A handle on the disk image which stays open for the life of the mount.
+
+    Two backends are available:
+        'pread': positional os.pread/os.pwrite calls on a single descriptor.
+        'mmap':  the image is mapped into memory, and view_block returns
+                 zero-copy memoryview slices of the mapping.
+
+    The geometry is read from the image's superblock unless one is given,
+    which format does before the superblock has been written.
+
+    With io_threads, the pread backend issues the runs of a multi-block
+    request concurrently on an IOEngine rather than one after another.
+    '''
+
+    BACKENDS = ('pread', 'mmap')
+
+    # the most buffers a single preadv/pwritev call may be given
+    try:
+        IOV_MAX = os.sysconf('SC_IOV_MAX')
+    except (AttributeError, ValueError, OSError):
+        IOV_MAX = 1024
+
+    def __init__(self, disk_name=DISK_NAME, backend='pread', superblock=None, io_threads=0):
+        if backend not in self.BACKENDS:
+            raise ValueError('Unknown block device backend: ' + backend)
+        self.disk_name = disk_name
+        self.backend = backend
+        self.fd = os.open(disk_name, os.O_RDWR)
+        try:
+            self.superblock = superblock or Superblock.read(self.fd)
+        except Exception:
+            os.close(self.fd)
+            raise
+        self.block_size = self.superblock.block_size
+        self.num_blocks = self.superblock.num_blocks
+        self.map = None
+        self.view = None
+        # block I/O counters. A read or write is one system call, or one
+        # copy in or out of the mapping for the mmap backend.
+        self.reads = self.writes = self.syncs = 0
+        self.blocks_read = self.blocks_written = 0
+        self.engine = None
+        self.run_limit = self.IOV_MAX
+        if backend == 'mmap':
+            self.map = mmap.mmap(self.fd, self.num_blocks * self.block_size)
+            self.view = memoryview(self.map)
+        elif io_threads:
+            self.engine = IOEngine(io_threads)
+            self.run_limit = min(self.IOV_MAX, self.engine.chunk_blocks)
+
+    def check_block_num(self, block_num):
+        if block_num >= self.num_blocks:
+            raise IOError('Block number out of range')
+
+    def view_block(self, block_num):
+        '''Returns a read-only view of block_num. For the mmap backend
+        this is a slice of the mapping and no data is copied, so it must be
+        released before the device is closed.'''
+        self.check_block_num(block_num)
+        start = block_num * self.block_size
+        self.reads += 1
+        self.blocks_read += 1
+        if self.view is not None:
+            return self.view[start:start + self.block_size].toreadonly()
+        return memoryview(os.pread(self.fd, self.block_size, start))
+
+    def read_block(self, block_num):
+        '''Reads block_num block from the file system.
+            Return: a bytearray of block_size
+        '''
+        self.check_block_num(block_num)
+        start = block_num * self.block_size
+        self.reads += 1
+        self.blocks_read += 1
+        if self.view is not None:
+            return bytearray(self.view[start:start + self.block_size])
+        return bytearray(os.pread(self.fd, self.block_size, start))
+
+    def write_block(self, block_num, data):
+        '''Writes data to the block_num block.'''
+        self.check_block_num(block_num)
+        start = block_num * self.block_size
+        self.writes += 1
+        self.blocks_written += 1
+        if self.view is not None:
+            self.view[start:start + len(data)] = data
+        else:
+            os.pwrite(self.fd, data, start)
+
+    def runs(self, block_nums):
+        '''Sorts block_nums and splits them into runs of adjacent blocks, each
+        at most IOV_MAX long, or the engine's chunk size if there is an
+        engine. Yields lists of (block_num, position) where position is the
+        block's index in block_nums.'''
+        run = []
+        for block_num, position in sorted(zip(block_nums, range(len(block_nums)))):
+            self.check_block_num(block_num)
+            if run and (block_num != run[-1][0] + 1 or len(run) == self.run_limit):
+                yield run
+                run = []
+            run.append((block_num, position))
+        if run:
+            yield run
+
+    def read_blocks(self, block_nums, buffer=None):
+        '''Reads every block in block_nums, using one preadv per run of
+        adjacent blocks. Block block_nums[i] is placed at i * block_size in
+        buffer, which is allocated if not supplied. Return: the buffer
+        '''
+        if buffer is None:
+            buffer = bytearray(len(block_nums) * self.block_size)
+        view = memoryview(buffer)
+
+        calls = []
+        for run in self.runs(block_nums):
+            start = run[0][0] * self.block_size
+            self.reads += 1
+            self.blocks_read += len(run)
+            if self.view is not None:
+                for i, (_, position) in enumerate(run):
+                    block_start = start + i * self.block_size
+                    view[position * self.block_size:(position + 1) * self.block_size] = \
+                        self.view[block_start:block_start + self.block_size]
+            else:
+                buffers = [view[position * self.block_size:(position + 1) * self.block_size]
+                           for _, position in run]
+                calls.append((os.preadv, self.fd, buffers, start))
+        self.issue(calls)
+        return buffer
+
+    def write_blocks(self, blocks):
+        '''Writes a dictionary of block_num: whole block data, using one
+        pwritev per run of adjacent blocks.'''
+        block_nums = list(blocks)
+        calls = []
+        for run in self.runs(block_nums):
+            start = run[0][0] * self.block_size
+            self.writes += 1
+            self.blocks_written += len(run)
+            if self.view is not None:
+                for i, (block_num, _) in enumerate(run):
+                    block_start = start + i * self.block_size
+                    self.view[block_start:block_start + self.block_size] = blocks[block_num]
+            else:
+                buffers = [blocks[block_num] for block_num, _ in run]
+                calls.append((os.pwritev, self.fd, buffers, start))
+        self.issue(calls)
+
+    def issue(self, calls):
+        '''Makes the system calls of one request, in parallel on the engine
+        when there is more than one.'''
+        if self.engine is not None and len(calls) > 1:
+            self.engine.run(calls)
+            return
+        for call in calls:
+            call[0](*call[1:])
+
+    def sync(self):
+        '''Forces written blocks down to the disk image.'''
+        self.syncs += 1
+        if self.map is not None:
+            self.map.flush()
+        os.fsync(self.fd)
+
+    def stats(self):
+        return dict(reads=self.reads, writes=self.writes, syncs=self.syncs,
+                    blocks_read=self.blocks_read, blocks_written=self.blocks_written)
+
+    def close(self):
+        if self.fd is None:
+            return
+        if self.map is not None:
+            self.view.release()
+            self.map.close()
+            self.view = self.map = None
+        if self.engine is not None:
+            self.engine.close()
+            self.engine = None
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 
 def print_block(block_num):
     '''Prints block_num block data.'''
@@ -66,4 +313,3 @@ def bytes_to_int(bytes):
 if __name__ == '__main__':
     low_level_format()
     os.system('od --address-radix=x -t x1 -a my-disk')
-    
\ No newline at end of file
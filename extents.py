@@ -0,0 +1,174 @@
+''' Maps each block of a file to the disk block holding it '''
+from bisect import bisect_right
+
+from constants import NO_BLOCK
+
+
+class ExtentMap(object):
+    '''A file's data blocks as a list of [start, length] runs, in file order.
+
+    logical_starts[i] is the index within the file of the first block of
+    extents[i], so the disk block for any file block is one binary search
+    away. map_blocks are the overflow blocks the map is stored in once it
+    no longer fits in the file's metadata block.
+
+    An extent starting at NO_BLOCK is a hole: its file blocks have never been
+    written, take no space on disk and read back as zeros.
+    '''
+
+    def __init__(self, extents=(), map_blocks=()):
+        self.extents = [list(extent) for extent in extents]
+        self.map_blocks = list(map_blocks)
+
+        self.logical_starts = []
+        self.num_blocks = 0
+        for _, length in self.extents:
+            self.logical_starts.append(self.num_blocks)
+            self.num_blocks += length
+
+        # index of the first extent changed since the map was last saved
+        self.dirty_from = len(self.extents)
+
+    def __len__(self):
+        return self.num_blocks
+
+    def find(self, index):
+        ''' returns the position in extents of the run holding file block index'''
+        return bisect_right(self.logical_starts, index) - 1
+
+    def runs(self, first, count):
+        ''' yields (file block index, disk block, length) for each run of
+        contiguous disk blocks covering file blocks first to first + count - 1.
+        The disk block of a run within a hole is NO_BLOCK.'''
+        end = min(first + count, self.num_blocks)
+        index = first
+        i = self.find(first)
+        while index < end:
+            start, length = self.extents[i]
+            offset = index - self.logical_starts[i]
+            run = min(length - offset, end - index)
+            yield index, start if start == NO_BLOCK else start + offset, run
+            index += run
+            i += 1
+
+    def blocks(self, first=0, count=None):
+        ''' returns the disk blocks holding file blocks first to first + count - 1,
+        with NO_BLOCK for each block in a hole'''
+        if count is None:
+            count = self.num_blocks - first
+        block_nums = []
+        for _, start, length in self.runs(first, count):
+            if start == NO_BLOCK:
+                block_nums.extend([NO_BLOCK] * length)
+            else:
+                block_nums.extend(range(start, start + length))
+        return block_nums
+
+    def allocated_blocks(self, first=0):
+        ''' returns the disk blocks holding file blocks from first on, skipping holes'''
+        return [block_num for block_num in self.blocks(first) if block_num != NO_BLOCK]
+
+    def append(self, block_nums):
+        ''' adds block_nums to the end of the file, extending the last run
+        whenever a block follows straight on from it'''
+        for block_num in block_nums:
+            if self.extents and self.extents[-1][0] != NO_BLOCK \
+                    and sum(self.extents[-1]) == block_num:
+                self.extents[-1][1] += 1
+            else:
+                self.logical_starts.append(self.num_blocks)
+                self.extents.append([block_num, 1])
+            self.dirty_from = min(self.dirty_from, len(self.extents) - 1)
+            self.num_blocks += 1
+
+    def append_hole(self, count):
+        ''' adds count unwritten blocks to the end of the file'''
+        if not count:
+            return
+        if self.extents and self.extents[-1][0] == NO_BLOCK:
+            self.extents[-1][1] += count
+        else:
+            self.logical_starts.append(self.num_blocks)
+            self.extents.append([NO_BLOCK, count])
+        self.dirty_from = min(self.dirty_from, len(self.extents) - 1)
+        self.num_blocks += count
+
+    def split(self, index):
+        ''' makes an extent start at file block index, returning its position'''
+        if index >= self.num_blocks:
+            return len(self.extents)
+        i = self.find(index)
+        offset = index - self.logical_starts[i]
+        if not offset:
+            return i
+
+        start, length = self.extents[i]
+        self.extents[i][1] = offset
+        self.extents.insert(i + 1, [start if start == NO_BLOCK else start + offset,
+                                    length - offset])
+        self.logical_starts.insert(i + 1, index)
+        return i + 1
+
+    def assign(self, first, block_nums):
+        ''' maps file blocks from first on to block_nums, which replace what
+        was there before. Any gap between the end of the file and first
+        becomes a hole. Neighbouring runs are merged afterwards.'''
+        if not block_nums:
+            return
+        end = first + len(block_nums)
+        if end > self.num_blocks:
+            self.append_hole(end - self.num_blocks)
+
+        i = self.split(first)
+        j = self.split(end)
+        runs = []
+        for block_num in block_nums:
+            if runs and follows(runs[-1], [block_num, 1]):
+                runs[-1][1] += 1
+            else:
+                runs.append([block_num, 1])
+        self.extents[i:j] = runs
+
+        # merge from the extent before the change, then renumber the rest
+        i = max(i - 1, 0)
+        merged = self.extents[:i + 1]
+        for extent in self.extents[i + 1:]:
+            if follows(merged[-1], extent):
+                merged[-1][1] += extent[1]
+            else:
+                merged.append(extent)
+        self.extents = merged
+
+        del self.logical_starts[i:]
+        position = self.logical_starts[-1] + self.extents[i - 1][1] if i else 0
+        for _, length in self.extents[i:]:
+            self.logical_starts.append(position)
+            position += length
+        self.dirty_from = min(self.dirty_from, i)
+
+    def truncate(self, count):
+        ''' keeps only the first count blocks, returning the disk blocks freed'''
+        if count >= self.num_blocks:
+            return []
+        freed = self.allocated_blocks(count)
+
+        if count == 0:
+            i = -1
+        else:
+            i = self.find(count - 1)
+            self.extents[i][1] = count - self.logical_starts[i]
+        del self.extents[i + 1:]
+        del self.logical_starts[i + 1:]
+
+        self.dirty_from = min(self.dirty_from, max(i, 0))
+        self.num_blocks = count
+        return freed
+
+
+
+def follows(extent, next_extent):
+    ''' whether next_extent carries straight on from extent, so the two can be
+    one run. Two holes always can.'''
+    if extent[0] == NO_BLOCK or next_extent[0] == NO_BLOCK:
+        return extent[0] == next_extent[0]
+    return sum(extent) == next_extent[0]
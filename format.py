@@ -1,6 +1,7 @@
 from logging import getLogger
 from os import write
-from disktools import BLOCK_SIZE, NUM_BLOCKS, int_to_bytes, print_block, write_block
+from codec import METADATA, JOURNAL_HEADER
+from disktools import BlockDevice, Superblock, low_level_format
 from constants import *
 
 from errno import EINVAL
@@ -15,96 +16,98 @@ UID = getuid()
 GID = getgid()
 
 
-def create_file_data(path, o_mode, st_n_link=1):
-    '''Create the file's data (metadata)'''
+def create_file_data(name, o_mode, st_n_link=1):
+    '''Create the file's data (metadata) as the fields of its metadata record'''
     int_now = int(time())
 
-    st_mode = int_to_bytes(o_mode, ST_MODE_SIZE)
-    st_uid = int_to_bytes(UID, ST_UID_SIZE)
-    st_gid = int_to_bytes(GID, ST_GID_SIZE)
-    st_nlink = int_to_bytes(st_n_link, ST_NLINKS_SIZE)
-    st_size = int_to_bytes(0, ST_SIZE_SIZE)
-    st_ctime = int_to_bytes(int_now, ST_CTIME_SIZE)
-    st_mtime = int_to_bytes(int_now, ST_MTIME_SIZE)
-    st_atime = int_to_bytes(int_now, ST_ATIME_SIZE)
-
-    st_name = path_name_as_bytes(path)
-
-    file_data = st_mode + st_uid + st_gid + st_nlink + st_size + \
-        st_ctime + st_mtime + st_atime + st_name
-
-    return file_data
-
-
-def format_dir(path, mode, file_num=0, next_free_block=1):
-    ''' Used to format a directory, including the root which uses the 0th block'''
-
-    next_free_block = int_to_bytes(next_free_block, NEXT_BLOCK_SIZE)
-    # Block index out of range is used to indicate no next block
-    next_file = int_to_bytes(NUM_BLOCKS, NEXT_FILE_SIZE)
-
-    metadata = create_file_data(path, (S_IFDIR | mode), 2)
-
-    fh = int_to_bytes(0, FH_SIZE)
-
-    # 1 + 1 + 37 + 1
-    root_data = next_file + next_free_block + metadata + fh
-    padded_root_data = root_data + bytearray(BLOCK_SIZE - len(root_data))
-
-    write_block(file_num, padded_root_data)
-
-
-def format_block(block_num, next_free_block):
-    '''formats a regular block and points it to next_free_block'''
-    null_next_file = int_to_bytes(NUM_BLOCKS, NEXT_FILE_SIZE)
-    next_block = int_to_bytes(next_free_block, NEXT_BLOCK_SIZE)
-    padded_data = null_next_file + next_block + \
-        bytearray(BLOCK_SIZE - (NEXT_FILE_SIZE + NEXT_BLOCK_SIZE))
-    write_block(block_num, padded_data)
-
-
-def format_all_blocks():
-    '''formats all blocks EXCEPT ROOT'''
-    for i in range(1, NUM_BLOCKS):
-        format_block(i, i+1)
-
-
-def path_name_as_bytes(path):
-    ''' converts a path name to a 16 byte array of ascii '''
-    name_bytes = []
-
-    file_name = path
-
-    if not file_name:
-        file_name = '/'
-
-    for c in file_name:
-        name_bytes.append(int_to_bytes(ord(c), 1))
-
-    if NAME_SIZE - len(name_bytes) < 0:
+    return dict(next_file=NO_BLOCK, next_block=NO_BLOCK,
+                st_mode=o_mode, st_uid=UID, st_gid=GID, st_nlink=st_n_link,
+                st_size=0, st_ctime=int_now, st_mtime=int_now, st_atime=int_now,
+                name=path_name_as_bytes(name), fh=0, extent_count=0, flags=0)
+
+
+def create_metadata_block(block_size, name, o_mode, st_n_link=1):
+    '''Create a whole metadata block for a new file with no data. name is the
+    last component of its path.'''
+    block = bytearray(block_size)
+    METADATA.pack_into(block, **create_file_data(name, o_mode, st_n_link))
+    return block
+
+
+def format_dir(disk, name, mode, file_num=None):
+    ''' Used to format an empty directory, including the root which uses the
+    block after the journal when file_num is not given'''
+    if file_num is None:
+        file_num = disk.superblock.root_loc
+
+    disk.write_block(file_num, create_metadata_block(
+        disk.block_size, name, (S_IFDIR | mode), 2))
+
+
+def format_all_blocks(disk):
+    '''builds the free space bitmap, in which only the superblock, the bitmap
+    blocks themselves, the journal and the root are in use. Only the bitmap
+    blocks holding those bits are written: the rest of the image is still
+    zero, which marks every other block free without touching it.'''
+    sb = disk.superblock
+    used = sb.root_loc + 1
+    written = -(-used // (sb.block_size * 8))
+    bitmap = bytearray(written * sb.block_size)
+    bitmap[:used // 8] = b'\xff' * (used // 8)
+    for block_num in range(used // 8 * 8, used):
+        bitmap[block_num // 8] |= 1 << (block_num % 8)
+
+    disk.write_blocks(dict((sb.bitmap_loc + i, bitmap[i * sb.block_size:(i + 1) * sb.block_size])
+                           for i in range(written)))
+
+
+def format_journal(disk):
+    '''writes the marker which starts an empty journal'''
+    marker = bytearray(disk.block_size)
+    JOURNAL_HEADER.pack_into(marker, magic=JOURNAL_MAGIC, sequence=0, count=0, checksum=0)
+    disk.write_block(disk.superblock.journal_loc, marker)
+
+
+def format_disk(disk_name=DISK_NAME, block_size=DEFAULT_BLOCK_SIZE,
+                num_blocks=DEFAULT_NUM_BLOCKS):
+    '''creates a new disk image with the given geometry, holding only the root.
+    Only the superblock, the used part of the bitmap, the journal marker and
+    the root are written, so the time taken does not grow with the image.'''
+    sb = Superblock(block_size, num_blocks)
+    low_level_format(num_blocks, block_size, disk_name)
+    with BlockDevice(disk_name, superblock=sb) as disk:
+        disk.write_block(SUPERBLOCK_LOC, sb.pack())
+        format_all_blocks(disk)
+        format_journal(disk)
+        format_dir(disk, '/', 0o755)
+    return sb
+
+
+def path_name_as_bytes(name):
+    ''' converts a file name to ascii, which the record pads to 16 bytes '''
+    try:
+        name = (name or '/').encode('ascii')
+    except UnicodeEncodeError:
         raise FuseOSError(EINVAL)
 
-    name_bytes.append(bytearray(NAME_SIZE - len(name_bytes)))
-
-    name = b''.join(name_bytes)
+    if len(name) > NAME_SIZE:
+        raise FuseOSError(EINVAL)
 
     return name
 
 
 def bytes_to_pathname(bytes):
     ''' converts a 16 byte array to a path name '''
-    ascii_name = []
-    for int_val in bytes:
-        if int_val == 0:
-            break
-        else:
-            ascii_name.append(chr(int_val))
-
-    return ''.join(ascii_name)
+    return bytes.split(b'\x00', 1)[0].decode('ascii')
 
 
 if __name__ == '__main__':
-    format_all_blocks()
-    format_dir('/', 0o755)
-    for i in range(10):
-        print_block(i)
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument('--num-blocks', type=int, default=DEFAULT_NUM_BLOCKS)
+    args = parser.parse_args()
+
+    sb = format_disk(DISK_NAME, args.block_size, args.num_blocks)
+    print('formatted', DISK_NAME, 'version', sb.version, 'with', sb.num_blocks,
+          'blocks of', sb.block_size, 'bytes, root at block', sb.root_loc)
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+''' Offline checker for SmallDisk images.
+
+The image is memory-mapped as a NumPy array of shape (num_blocks, block_size)
+and the tree is checked one directory level at a time: the fields of every
+metadata block, map block and directory entry at that level are pulled out
+as columns in a handful of vectorised operations, so the time taken depends
+on the depth of the tree rather than on the number of files.
+
+Exit status follows e2fsck: 0 clean, 1 errors corrected, 4 errors left
+uncorrected, 8 the image could not be checked.
+'''
+from __future__ import print_function, division
+
+import os
+import sys
+
+from stat import S_IFDIR, S_IFREG
+
+import numpy as np
+
+from codec import METADATA, MAP_HEADER, JOURNAL_HEADER, EXTENT, DIRENT, EXTENT_LOC, MAP_EXTENT_LOC, \
+    INLINE_DATA_LOC
+from disktools import BlockDevice, Superblock
+from constants import *
+
+EXIT_CLEAN = 0
+EXIT_CORRECTED = 1
+EXIT_UNCORRECTED = 4
+EXIT_ERROR = 8
+
+# file type bits of st_mode, as stat.S_IFMT only takes a single mode
+IFMT = 0o170000
+
+# numpy dtypes for the struct formats used by the record schemas
+DTYPES = dict(B='u1', H='>u2', I='>u4', Q='>u8')
+
+
+def name_of(raw):
+    ''' decodes a stored name, without format, which needs fuse'''
+    return raw.split(b'\x00', 1)[0].decode('ascii', 'replace')
+
+
+def column(img, block_nums, record, name):
+    ''' returns field name of record, read out of every block in block_nums'''
+    loc, field = record.fields[name]
+    raw = np.ascontiguousarray(img[block_nums, loc:loc + field.size])
+    return raw.view(DTYPES[field.format[-1]]).ravel().astype(np.int64)
+
+
+def expand(starts, lengths):
+    ''' returns the block numbers covered by each (start, length) extent, in order'''
+    total = int(lengths.sum())
+    if not total:
+        return np.zeros(0, np.int64)
+    which = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return starts[which] + offsets
+
+
+class Checker(object):
+    '''Checks one image, collecting a message for each problem found.'''
+
+    def __init__(self, img, superblock, out=sys.stdout):
+        self.img = img
+        self.sb = superblock
+        self.block_size = superblock.block_size
+        self.num_blocks = superblock.num_blocks
+        self.first_data = superblock.root_loc + 1
+        self.inline_extents = (self.block_size - EXTENT_LOC) // EXTENT.size
+        self.map_block_extents = (self.block_size - MAP_EXTENT_LOC) // EXTENT.size
+        self.dirents_per_block = self.block_size // DIRENT.size
+        self.out = out
+        self.problems = 0
+        self.unfixed = 0
+
+    def report(self, message, count=1, fixable=False):
+        if count:
+            print(message, file=self.out)
+            self.problems += count
+            if not fixable:
+                self.unfixed += count
+
+    ##### EXTENTS #####
+
+    def valid_blocks(self, block_nums):
+        return (block_nums >= self.first_data) & (block_nums < self.num_blocks)
+
+    def read_extents(self, files):
+        ''' returns (owner, start, length) arrays of the extents of every file
+        in files, ordered by owner then by position in the file, and the
+        (owner, block) arrays of the map blocks holding them'''
+        n = len(files)
+        counts = column(self.img, files, METADATA, 'extent_count')
+        bad = counts > self.inline_extents
+        self.report('%d files with more inline extents than fit' % bad.sum(), int(bad.sum()))
+        counts = np.minimum(counts, self.inline_extents)
+
+        raw = np.ascontiguousarray(
+            self.img[files, EXTENT_LOC:EXTENT_LOC + self.inline_extents * EXTENT.size])
+        pairs = raw.view('>u4').reshape(n, self.inline_extents, 2).astype(np.int64)
+        present = np.arange(self.inline_extents) < counts[:, None]
+        owners = [np.nonzero(present)[0]]
+        ranks = [np.nonzero(present)[1]]
+        starts = [pairs[..., 0][present]]
+        lengths = [pairs[..., 1][present]]
+
+        # follow every chain of map blocks one hop at a time
+        map_owners = []
+        map_blocks = []
+        seen = np.zeros(self.num_blocks, bool)
+        owner = np.arange(n)
+        current = column(self.img, files, METADATA, 'next_block')
+        hop = 0
+        while True:
+            following = current != NO_BLOCK
+            owner, current = owner[following], current[following]
+            if not len(current):
+                break
+            bad = ~self.valid_blocks(current)
+            self.report('%d map block pointers out of range' % bad.sum(), int(bad.sum()))
+            owner, current = owner[~bad], current[~bad]
+            looped = seen[current]
+            self.report('%d map block chains looping or cross-linked' % looped.sum(),
+                        int(looped.sum()))
+            owner, current = owner[~looped], current[~looped]
+            seen[current] = True
+            map_owners.append(owner)
+            map_blocks.append(current)
+
+            counts = np.minimum(column(self.img, current, MAP_HEADER, 'extent_count'),
+                                self.map_block_extents)
+            raw = np.ascontiguousarray(self.img[
+                current, MAP_EXTENT_LOC:MAP_EXTENT_LOC + self.map_block_extents * EXTENT.size])
+            pairs = raw.view('>u4').reshape(len(current), self.map_block_extents, 2).astype(np.int64)
+            present = np.arange(self.map_block_extents) < counts[:, None]
+            rows, slots = np.nonzero(present)
+            owners.append(owner[rows])
+            ranks.append(self.inline_extents + hop * self.map_block_extents + slots)
+            starts.append(pairs[..., 0][present])
+            lengths.append(pairs[..., 1][present])
+
+            current = column(self.img, current, MAP_HEADER, 'next_block')
+            hop += 1
+
+        owners, ranks = np.concatenate(owners), np.concatenate(ranks)
+        order = np.lexsort((ranks, owners))
+        extents = (owners[order], np.concatenate(starts)[order], np.concatenate(lengths)[order])
+        maps = (np.concatenate(map_owners) if map_owners else np.zeros(0, np.int64),
+                np.concatenate(map_blocks) if map_blocks else np.zeros(0, np.int64))
+        return extents, maps
+
+    ##### TREE #####
+
+    def check(self):
+        ''' walks the tree from the root, then compares what it found with the
+        bitmap. Returns the block reference counts.'''
+        refs = [np.arange(self.sb.root_loc)]
+        visited = np.zeros(self.num_blocks, bool)
+        visited[self.sb.root_loc] = True
+        level = np.array([self.sb.root_loc], np.int64)
+        self.nlink_fixes = []
+        self.regular_files = 0
+
+        while len(level):
+            refs.append(level)
+            modes = column(self.img, level, METADATA, 'st_mode')
+            sizes = column(self.img, level, METADATA, 'st_size')
+            is_dir = (modes & IFMT) == S_IFDIR
+            self.regular_files += int(((modes & IFMT) == S_IFREG).sum())
+
+            (owner, starts, lengths), (map_owner, map_blocks) = self.read_extents(level)
+            refs.append(map_blocks)
+            holes = starts == NO_BLOCK
+            bad = ~holes & ((starts < self.first_data) | (starts + lengths > self.num_blocks))
+            self.report('%d extents outside the data area' % bad.sum(), int(bad.sum()))
+            keep = ~holes & ~bad
+            refs.append(expand(starts[keep], lengths[keep]))
+
+            # each file's extent map covers exactly the blocks its size needs
+            mapped = np.bincount(owner, weights=lengths, minlength=len(level)).astype(np.int64)
+            needed = np.where(is_dir, -(-(sizes // DIRENT.size) // self.dirents_per_block),
+                              -(-sizes // self.block_size))
+            # inline files keep their data in the metadata block, and have no extents
+            inline = (column(self.img, level, METADATA, 'flags') & INLINE_DATA) != 0
+            needed[inline] = 0
+            misfit = inline & (is_dir | (sizes > self.block_size - INLINE_DATA_LOC))
+            self.report('%d inline files too large or not regular files' % misfit.sum(),
+                        int(misfit.sum()))
+            wrong = mapped != needed
+            for file_num in level[wrong][:10]:
+                print('size of block %d does not match its extents' % file_num, file=self.out)
+            self.report('%d files whose size does not match their extents' % wrong.sum(),
+                        int(wrong.sum()))
+
+            children, child_dirs = self.read_entries(level, is_dir, sizes, owner, starts,
+                                                     lengths, holes | bad)
+            self.check_nlink(level, is_dir, child_dirs)
+
+            again = visited[children]
+            self.report('%d directory entries pointing at a file already seen '
+                        '(directory cycle or cross-link)' % again.sum(), int(again.sum()))
+            children = np.unique(children[~again])
+            visited[children] = True
+            level = children
+
+        fh = column(self.img, np.array([self.sb.root_loc]), METADATA, 'fh')[0]
+        if fh < self.regular_files:
+            self.report('root fh counter %d is below the %d files' % (fh, self.regular_files))
+        return np.bincount(np.concatenate(refs).astype(np.int64), minlength=self.num_blocks)
+
+    def read_entries(self, level, is_dir, sizes, owner, starts, lengths, unusable):
+        ''' returns the metadata blocks named by the entries of the directories
+        in level, and how many of each directory's children are directories'''
+        dirs = is_dir[owner] & ~unusable
+        self.report('%d holes or bad extents in directories' % (is_dir[owner] & unusable).sum(),
+                    int((is_dir[owner] & unusable).sum()))
+        lengths = lengths[dirs]
+        blocks = expand(starts[dirs], lengths)
+        block_owner = np.repeat(owner[dirs], lengths)
+        if not len(blocks):
+            return np.zeros(0, np.int64), np.zeros(len(level), np.int64)
+
+        # position of each block within its directory
+        first = np.r_[0, np.nonzero(np.diff(block_owner))[0] + 1]
+        index = np.arange(len(blocks)) - np.repeat(first, np.diff(np.r_[first, len(blocks)]))
+
+        per_block = self.dirents_per_block
+        raw = np.ascontiguousarray(self.img[blocks, :per_block * DIRENT.size])
+        entries = raw.reshape(len(blocks), per_block, DIRENT.size)
+        slots = index[:, None] * per_block + np.arange(per_block)
+        live = slots < (sizes[block_owner] // DIRENT.size)[:, None]
+
+        file_nums = np.ascontiguousarray(entries[..., NAME_SIZE:NAME_SIZE + BLOCK_PTR_SIZE][live])
+        file_nums = file_nums.view('>u4').ravel().astype(np.int64)
+        parents = np.broadcast_to(block_owner[:, None], live.shape)[live]
+        bad = ~self.valid_blocks(file_nums)
+        self.report('%d directory entries pointing outside the data area' % bad.sum(),
+                    int(bad.sum()))
+        file_nums, parents = file_nums[~bad], parents[~bad]
+
+        modes = column(self.img, file_nums, METADATA, 'st_mode')
+        child_dirs = np.bincount(parents[(modes & IFMT) == S_IFDIR], minlength=len(level))
+        return file_nums, child_dirs
+
+    def check_nlink(self, level, is_dir, child_dirs):
+        nlinks = column(self.img, level, METADATA, 'st_nlink')
+        expected = np.where(is_dir, 2 + child_dirs, 1)
+        wrong = nlinks != expected
+        self.report('%d files with the wrong link count' % wrong.sum(), int(wrong.sum()),
+                    fixable=True)
+        self.nlink_fixes.append((level[wrong], expected[wrong]))
+
+    ##### BITMAP #####
+
+    def read_bitmap(self):
+        sb = self.sb
+        raw = np.asarray(self.img[sb.bitmap_loc:sb.bitmap_loc + sb.bitmap_blocks]).ravel()
+        return np.unpackbits(raw, bitorder='little')[:self.num_blocks].astype(bool)
+
+    def check_bitmap(self, refcount):
+        used = self.read_bitmap()
+        crossed = refcount > 1
+        self.report('%d blocks claimed more than once' % crossed.sum(), int(crossed.sum()))
+        leaked = used & (refcount == 0)
+        self.report('%d blocks marked used that nothing holds' % leaked.sum(), int(leaked.sum()),
+                    fixable=True)
+        lost = ~used & (refcount > 0)
+        self.report('%d blocks in use but marked free' % lost.sum(), int(lost.sum()),
+                    fixable=True)
+        return leaked.any() or lost.any()
+
+    def check_journal(self):
+        ''' returns whether the journal holds committed records not yet replayed'''
+        loc = self.sb.journal_loc
+        marker = bytes(self.img[loc, :JOURNAL_HEADER.size])
+        if JOURNAL_HEADER.get(marker, 'magic') != JOURNAL_MAGIC:
+            self.report('journal marker is missing')
+            return False
+        record = bytes(self.img[loc + 1, :JOURNAL_HEADER.size])
+        return JOURNAL_HEADER.get(record, 'magic') == JOURNAL_MAGIC and \
+            JOURNAL_HEADER.get(record, 'count') > 0 and \
+            JOURNAL_HEADER.get(record, 'sequence') == JOURNAL_HEADER.get(marker, 'sequence') + 1
+
+    ##### REPAIR #####
+
+    def repair(self, refcount):
+        ''' rewrites the bitmap from the blocks found in use, and fixes link
+        counts. Cross-links, cycles and size mismatches are only reported.'''
+        sb = self.sb
+        bits = np.packbits(refcount > 0, bitorder='little')
+        bitmap = np.zeros(sb.bitmap_blocks * self.block_size, np.uint8)
+        bitmap[:len(bits)] = bits
+        self.img[sb.bitmap_loc:sb.bitmap_loc + sb.bitmap_blocks] = \
+            bitmap.reshape(sb.bitmap_blocks, self.block_size)
+
+        # the free block count in any checkpoint no longer matches the bitmap
+        self.img[sb.checkpoint_loc] = 0
+
+        loc = METADATA.loc('st_nlink')
+        for block_nums, nlinks in self.nlink_fixes:
+            self.img[block_nums, loc] = nlinks
+        self.img.flush()
+
+
+def replay_journal(disk_name):
+    ''' mounting the journal replays it, and closing it empties it'''
+    from cache import BlockCache
+    from journal import Journal
+    Journal(BlockCache(BlockDevice(disk_name))).close()
+
+
+def inspect(img, superblock, block_num, out=sys.stdout):
+    ''' prints block_num decoded as a metadata block, with its entries if it
+    is a directory'''
+    block = bytes(img[block_num])
+    fields = METADATA.unpack(block)
+    fields['name'] = name_of(fields['name'])
+    for name in METADATA.names:
+        print('%-13s %r' % (name, fields[name]), file=out)
+    if fields['st_mode'] & IFMT == S_IFDIR:
+        checker = Checker(img, superblock, out)
+        (_, starts, lengths), _ = checker.read_extents(np.array([block_num]))
+        count = fields['st_size'] // DIRENT.size
+        for block in expand(starts, lengths):
+            raw = bytes(img[block, :checker.dirents_per_block * DIRENT.size])
+            for name, file_num in DIRENT.iter_unpack(raw[:min(count, checker.dirents_per_block) * DIRENT.size]):
+                print('  %-16s %d' % (name_of(name), file_num), file=out)
+            count -= checker.dirents_per_block
+
+
+def fsck(disk_name=DISK_NAME, repair=False, out=sys.stdout):
+    ''' checks the image, repairing what it can if asked. Returns the exit status.'''
+    try:
+        fd = os.open(disk_name, os.O_RDONLY)
+        try:
+            sb = Superblock.read(fd)
+        finally:
+            os.close(fd)
+    except (IOError, OSError) as e:
+        print('cannot check %s: %s' % (disk_name, e), file=out)
+        return EXIT_ERROR
+
+    shape = (sb.num_blocks, sb.block_size)
+    img = np.memmap(disk_name, np.uint8, 'r', shape=shape)
+    checker = Checker(img, sb, out)
+    replayed = checker.check_journal()
+    if replayed:
+        if not repair:
+            print('journal holds committed transactions; mount the image or use --repair '
+                  'to replay them before checking', file=out)
+            return EXIT_UNCORRECTED
+        del img, checker
+        replay_journal(disk_name)
+        print('replayed the journal', file=out)
+        img = np.memmap(disk_name, np.uint8, 'r', shape=shape)
+        checker = Checker(img, sb, out)
+
+    refcount = checker.check()
+    bitmap_wrong = checker.check_bitmap(refcount)
+    print('%s: %d problems, %d files, %d of %d blocks in use' % (
+        disk_name, checker.problems, checker.regular_files,
+        int((refcount > 0).sum()), sb.num_blocks), file=out)
+
+    if not checker.problems:
+        return EXIT_CORRECTED if replayed else EXIT_CLEAN
+    if repair and (bitmap_wrong or any(len(b) for b, _ in checker.nlink_fixes)):
+        checker.img = np.memmap(disk_name, np.uint8, 'r+', shape=shape)
+        checker.repair(refcount)
+        print('rewrote the bitmap and link counts', file=out)
+        return EXIT_UNCORRECTED if checker.unfixed else EXIT_CORRECTED
+    return EXIT_UNCORRECTED
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('disk', nargs='?', default=DISK_NAME)
+    parser.add_argument('--repair', action='store_true',
+                        help='replay the journal, rebuild the bitmap and fix link counts')
+    parser.add_argument('--inspect', type=int, metavar='BLOCK',
+                        help='print a metadata block and its directory entries, then exit')
+    args = parser.parse_args()
+
+    if args.inspect is not None:
+        with BlockDevice(args.disk) as disk:
+            sb = disk.superblock
+        inspect(np.memmap(args.disk, np.uint8, 'r', shape=(sb.num_blocks, sb.block_size)),
+                sb, args.inspect)
+        sys.exit(EXIT_CLEAN)
+    sys.exit(fsck(args.disk, args.repair))
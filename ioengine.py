@@ -0,0 +1,40 @@
+''' Thread pool which issues positional reads and writes concurrently '''
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from constants import IO_THREADS, IO_MAX_IN_FLIGHT, IO_CHUNK_BLOCKS
+
+
+class IOEngine(object):
+    '''Runs the system calls of one large request on a pool of threads.
+
+    os.preadv and os.pwritev release the GIL, so on a device with a deep
+    queue the pieces of a request are serviced in parallel. At most
+    max_in_flight calls are outstanding at once, and run returns only when
+    every call has finished.
+    '''
+
+    def __init__(self, threads=IO_THREADS, max_in_flight=IO_MAX_IN_FLIGHT,
+                 chunk_blocks=IO_CHUNK_BLOCKS):
+        if threads < 1:
+            raise ValueError('I/O engine needs at least one thread')
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix='block-io')
+        self.max_in_flight = max(max_in_flight, 1)
+        self.chunk_blocks = chunk_blocks
+
+    def run(self, calls):
+        ''' calls each (function, *args) in calls. The first exception raised
+        by any of them is raised once they have all finished.'''
+        pending = set()
+        done = []
+        for call in calls:
+            if len(pending) >= self.max_in_flight:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                done.extend(finished)
+            pending.add(self.pool.submit(*call))
+        done.extend(wait(pending)[0])
+
+        for future in done:
+            future.result()
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,366 @@
+''' Write-ahead journal which makes each FUSE operation's metadata updates atomic '''
+import threading
+import zlib
+
+from contextlib import contextmanager
+from functools import wraps
+
+from codec import JOURNAL_HEADER, BLOCK_PTR
+from constants import *
+
+
+def transactional(method):
+    '''Runs an operation on a SmallDisk inside one journal transaction, which
+    is abandoned if the operation raises'''
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.disk.transaction():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class Transaction(object):
+    '''The metadata blocks one operation has written, how to undo them, and
+    what to do once they have committed.
+
+    before holds the image each block had in the cache when the transaction
+    first wrote it, or None if it was not cached, in which case its home
+    location was up to date. Shared blocks, which concurrent transactions
+    also write, are not in before: their writer rebuilds them from its own
+    state in an undo callback instead.
+    '''
+
+    def __init__(self):
+        self.blocks = set()
+        self.before = dict()
+        self.undo = []
+        self.undo_keys = set()
+        self.done = []
+
+    def on_abort(self, callback, key=None):
+        ''' adds callback to those run, last added first, if the transaction
+        is abandoned. Only the first callback given a key is kept.'''
+        if key is not None:
+            if key in self.undo_keys:
+                return
+            self.undo_keys.add(key)
+        self.undo.append(callback)
+
+    def on_commit(self, callback):
+        ''' adds callback to those run, in order, once the transaction has
+        committed'''
+        self.done.append(callback)
+
+
+class Journal(object):
+    '''Sits in front of the block cache and groups metadata writes into
+    transactions.
+
+    Every block changed with write_block inside a transaction is pinned in
+    the cache. When the transaction ends, the final image of each block is
+    appended to the journal as one record, however many times the operation
+    changed it. Only then is the block unpinned and free to be written back
+    to its home location. Transactions which finish while a record is being
+    written are committed together in the next record, sharing its sync.
+
+    A transaction whose operation raises is abandoned instead: its blocks
+    get back the images they had before it and are unpinned unjournaled,
+    and its undo callbacks restore the in-memory state they were made from.
+
+    Data blocks are written with write_blocks, which is not journaled.
+
+    At mount, committed records left in the journal by an unclean shutdown
+    are replayed to their home locations.
+    '''
+
+    def __init__(self, disk, sync=True):
+        self.disk = disk
+        self.device = disk.device
+        self.superblock = superblock = disk.superblock
+        self.block_size = disk.block_size
+        self.num_blocks = disk.num_blocks
+        self.loc = superblock.journal_loc
+        self.blocks = superblock.journal_blocks
+        self.sync_commits = sync
+        # how many block numbers fit in a record's first block
+        self.max_record_blocks = min(
+            (self.block_size - JOURNAL_HEADER.size) // BLOCK_PTR.size, self.blocks - 2)
+
+        self.local = threading.local()
+        self.cond = threading.Condition()
+        self.pending = []
+        self.committing = False
+        self.next_ticket = 1
+        self.durable = 0
+        self.failed = dict()
+        # the last committed image of each block in the journal since the
+        # last marker
+        self.journaled = dict()
+
+        self.commits = 0
+        self.records = 0
+        self.aborts = 0
+
+        self.recover()
+
+    ##### TRANSACTIONS #####
+
+    @contextmanager
+    def transaction(self):
+        ''' collects the metadata writes made until the end of the block into
+        one transaction, which commits if the block finishes and is abandoned
+        if it raises. A nested transaction joins the one around it.'''
+        txn = getattr(self.local, 'txn', None)
+        if txn is not None:
+            yield txn
+            return
+
+        self.local.txn = txn = Transaction()
+        try:
+            yield txn
+        except BaseException:
+            self.local.txn = None
+            self.abort(txn)
+            raise
+        self.local.txn = None
+        if txn.blocks:
+            self.commit(txn.blocks)
+        for callback in txn.done:
+            callback()
+
+    def write_block(self, block_num, data, shared=False):
+        ''' writes a metadata block as part of the current transaction, or in
+        a transaction of its own if there is none. A shared block is not
+        restored if the transaction is abandoned.'''
+        txn = getattr(self.local, 'txn', None)
+        if txn is None:
+            self.disk.pin([block_num])
+            self.disk.write_block(block_num, data)
+            self.commit(set([block_num]))
+            return
+
+        if block_num not in txn.blocks:
+            self.disk.pin([block_num])
+            txn.blocks.add(block_num)
+            if not shared:
+                txn.before[block_num] = self.disk.peek_block(block_num)
+        self.disk.write_block(block_num, data)
+
+    def on_abort(self, callback, key=None):
+        ''' has callback run if the current transaction is abandoned. Outside a
+        transaction there is nothing to undo.'''
+        txn = getattr(self.local, 'txn', None)
+        if txn is not None:
+            txn.on_abort(callback, key)
+
+    def on_commit(self, callback):
+        ''' has callback run once the current transaction has committed, or
+        straight away outside a transaction'''
+        txn = getattr(self.local, 'txn', None)
+        if txn is None:
+            callback()
+        else:
+            txn.on_commit(callback)
+
+    def abort(self, txn):
+        ''' abandons txn, putting back the cached image of each block it wrote
+        and unpinning them without journaling, then running its undo callbacks'''
+        for block_num, image in txn.before.items():
+            if image is None:
+                self.disk.discard([block_num])
+            else:
+                self.disk.write_block(block_num, image)
+        self.disk.unpin(txn.blocks)
+        for callback in reversed(txn.undo):
+            callback()
+        self.aborts += 1
+
+    def commit(self, txn):
+        ''' waits until txn has been written to the journal, either by this
+        thread or by one already committing a group of transactions'''
+        with self.cond:
+            images = dict((block_num, bytes(self.disk.view_block(block_num)))
+                          for block_num in txn)
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            self.pending.append((ticket, images))
+            self.commits += 1
+
+            while self.durable < ticket:
+                if self.committing:
+                    self.cond.wait()
+                    continue
+
+                # this thread leads the commit of everything pending so far
+                self.committing = True
+                batch, self.pending = self.pending, []
+                error = None
+                self.cond.release()
+                try:
+                    self.write_batch(batch)
+                except Exception as e:
+                    error = e
+                finally:
+                    self.cond.acquire()
+                    self.committing = False
+
+                for batch_ticket, batch_images in batch:
+                    self.disk.unpin(batch_images)
+                    if error is not None:
+                        self.failed[batch_ticket] = error
+                self.durable = batch[-1][0]
+                self.cond.notify_all()
+
+            if ticket in self.failed:
+                raise self.failed.pop(ticket)
+
+    ##### JOURNAL RECORDS #####
+
+    def write_batch(self, batch):
+        ''' appends one record holding the merged images of every transaction
+        in batch, later transactions overriding earlier ones'''
+        images = dict()
+        for _, txn_images in batch:
+            images.update(txn_images)
+
+        if len(images) > self.max_record_blocks:
+            # too big for the journal, so the blocks go straight home instead
+            self.checkpoint(images)
+            return
+
+        if self.head + 1 + len(images) > self.blocks:
+            self.checkpoint()
+
+        self.device.write_blocks(self.pack_record(self.head, self.sequence, images))
+        if self.sync_commits:
+            self.device.sync()
+
+        self.journaled.update(images)
+        self.head += 1 + len(images)
+        self.sequence += 1
+        self.records += 1
+
+    def pack_record(self, pos, sequence, images):
+        ''' returns the journal blocks of a record, keyed by block number'''
+        block_nums = sorted(images)
+        numbers = b''.join(BLOCK_PTR.pack(block_num) for block_num in block_nums)
+        checksum = zlib.crc32(numbers)
+        for block_num in block_nums:
+            checksum = zlib.crc32(images[block_num], checksum)
+
+        header = bytearray(self.block_size)
+        JOURNAL_HEADER.pack_into(header, magic=JOURNAL_MAGIC, sequence=sequence,
+                                 count=len(block_nums), checksum=checksum)
+        header[JOURNAL_HEADER.end:JOURNAL_HEADER.end + len(numbers)] = numbers
+
+        record = {self.loc + pos: header}
+        for i, block_num in enumerate(block_nums):
+            record[self.loc + pos + 1 + i] = images[block_num]
+        return record
+
+    def write_marker(self, sequence):
+        ''' empties the journal. Records left after the marker have older
+        sequence numbers than it, so they are never replayed.'''
+        self.device.write_blocks(self.pack_record(0, sequence, dict()))
+        self.device.sync()
+        self.marker_sequence = sequence
+        self.head = 1
+        self.sequence = sequence + 1
+        self.journaled.clear()
+
+    def checkpoint(self, images=None):
+        ''' writes every committed block home, so the journal can start again.
+        Blocks still pinned by open transactions stay in the cache, so the
+        flush skips them: their last committed images are written home from
+        the journal instead, or the new marker would leave no copy of them.'''
+        self.disk.flush()
+        committed = dict((block_num, self.journaled[block_num])
+                         for block_num in self.disk.pinned_blocks(self.journaled))
+        if images:
+            committed.update(images)
+        if committed:
+            self.device.write_blocks(committed)
+        self.device.sync()
+        if self.head > 1:
+            self.write_marker(self.sequence)
+
+    def empty(self):
+        ''' checkpoints once no group commit is in progress. Only the leader
+        of a commit may otherwise touch the journal.'''
+        with self.cond:
+            while self.committing:
+                self.cond.wait()
+            self.checkpoint()
+
+    def recover(self):
+        ''' replays the records committed since the marker, then empties the journal'''
+        marker = self.device.read_block(self.loc)
+        if JOURNAL_HEADER.get(marker, 'magic') != JOURNAL_MAGIC:
+            raise IOError('Disk image has no journal')
+        sequence = JOURNAL_HEADER.get(marker, 'sequence')
+        # the marker left by the last unmount, which a checkpoint written
+        # then must match to be trusted
+        self.mounted_sequence = sequence
+
+        replayed = dict()
+        pos = 1
+        while pos < self.blocks:
+            header = self.device.read_block(self.loc + pos)
+            record = JOURNAL_HEADER.unpack(header)
+            count = record['count']
+            if record['magic'] != JOURNAL_MAGIC or record['sequence'] != sequence + 1 \
+                    or not count or pos + 1 + count > self.blocks:
+                break
+
+            numbers = bytes(header[JOURNAL_HEADER.end:JOURNAL_HEADER.end + count * BLOCK_PTR.size])
+            data = self.device.read_blocks(range(self.loc + pos + 1, self.loc + pos + 1 + count))
+            if zlib.crc32(data, zlib.crc32(numbers)) != record['checksum']:
+                # torn write of the last record, which was never committed
+                break
+
+            for i, (block_num,) in enumerate(BLOCK_PTR.iter_unpack(numbers)):
+                replayed[block_num] = data[i * self.block_size:(i + 1) * self.block_size]
+            sequence += 1
+            pos += 1 + count
+
+        if replayed:
+            self.device.write_blocks(replayed)
+            self.device.sync()
+        self.write_marker(sequence + 1)
+        self.replayed = len(replayed)
+
+    ##### BLOCK CACHE INTERFACE #####
+
+    def view_block(self, block_num):
+        return self.disk.view_block(block_num)
+
+    def read_block(self, block_num):
+        return self.disk.read_block(block_num)
+
+    def read_blocks(self, block_nums, buffer=None):
+        return self.disk.read_blocks(block_nums, buffer)
+
+    def write_blocks(self, blocks):
+        ''' writes data blocks, which are not journaled. A block freed from the
+        metadata and reused for data may still have an image in the journal,
+        so the journal is emptied first rather than risk replaying it.'''
+        if not self.journaled.keys().isdisjoint(blocks):
+            self.empty()
+        self.disk.write_blocks(blocks)
+
+    def flush(self):
+        self.disk.flush()
+
+    def sync(self):
+        self.disk.sync()
+
+    def close(self):
+        ''' writes everything home and empties the journal, so the next mount
+        has nothing to replay'''
+        self.empty()
+        self.disk.close()
+
+    def stats(self):
+        stats = self.disk.stats()
+        stats.update(commits=self.commits, journal_records=self.records, aborts=self.aborts)
+        return stats
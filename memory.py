@@ -3,61 +3,65 @@ from __future__ import print_function, absolute_import, division
 
 import logging
 
-from collections import defaultdict
-from errno import ENOENT
+from errno import EEXIST, EINVAL, ENOENT, ENOTEMPTY
 from stat import S_IFDIR, S_IFLNK, S_IFREG
 from time import time
 
-from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
+from fuse import FUSE, FuseOSError, Operations
 
-if not hasattr(__builtins__, 'bytes'):
+from metrics import MetricsMixIn
+from pages import PagedFile
+from tree import Node, walk, walk_parent
+
+try:
+    bytes
+except NameError:
     bytes = str
 
 
-class Memory(LoggingMixIn, Operations):
-    'Example memory filesystem. Supports only one level of files.'
+class Memory(MetricsMixIn, Operations):
+    '''Example memory filesystem. Directories hold their children by name,
+    so any depth of directories is supported.'''
 
     def __init__(self):
-        self.files = {}
-        self.data = defaultdict(bytes)
         self.fd = 0
         now = time()
-        self.files['/'] = dict(
+        self.root = Node(dict(
             st_mode=(S_IFDIR | 0o755),
             st_ctime=now,
             st_mtime=now,
             st_atime=now,
-            st_nlink=2)
+            st_nlink=2), children={})
 
     def chmod(self, path, mode):
-        self.files[path]['st_mode'] &= 0o770000
-        self.files[path]['st_mode'] |= mode
+        attrs = walk(self.root, path).attrs
+        attrs['st_mode'] &= 0o770000
+        attrs['st_mode'] |= mode
         return 0
 
     def chown(self, path, uid, gid):
-        self.files[path]['st_uid'] = uid
-        self.files[path]['st_gid'] = gid
+        attrs = walk(self.root, path).attrs
+        attrs['st_uid'] = uid
+        attrs['st_gid'] = gid
 
     def create(self, path, mode):
-        self.files[path] = dict(
+        parent, name = self.new_entry(path)
+        parent.children[name] = Node(dict(
             st_mode=(S_IFREG | mode),
             st_nlink=1,
             st_size=0,
             st_ctime=time(),
             st_mtime=time(),
-            st_atime=time())
+            st_atime=time()), data=PagedFile())
 
         self.fd += 1
         return self.fd
 
     def getattr(self, path, fh=None):
-        if path not in self.files:
-            raise FuseOSError(ENOENT)
-
-        return self.files[path]
+        return walk(self.root, path).attrs
 
     def getxattr(self, path, name, position=0):
-        attrs = self.files[path].get('attrs', {})
+        attrs = walk(self.root, path).attrs.get('attrs', {})
 
         try:
             return attrs[name]
@@ -65,35 +69,45 @@ class Memory(LoggingMixIn, Operations):
             return ''       # Should return ENOATTR
 
     def listxattr(self, path):
-        attrs = self.files[path].get('attrs', {})
+        attrs = walk(self.root, path).attrs.get('attrs', {})
         return attrs.keys()
 
     def mkdir(self, path, mode):
-        self.files[path] = dict(
+        parent, name = self.new_entry(path)
+        parent.children[name] = Node(dict(
             st_mode=(S_IFDIR | mode),
             st_nlink=2,
             st_size=0,
             st_ctime=time(),
             st_mtime=time(),
-            st_atime=time())
+            st_atime=time()), children={})
 
-        self.files['/']['st_nlink'] += 1
+        parent.attrs['st_nlink'] += 1
+
+    def new_entry(self, path):
+        ''' returns the directory which is to hold path and the name of the
+        entry, which must not exist yet'''
+        parent, name = walk_parent(self.root, path)
+        if name in parent.children:
+            raise FuseOSError(EEXIST)
+        return parent, name
 
     def open(self, path, flags):
         self.fd += 1
         return self.fd
 
     def read(self, path, size, offset, fh):
-        return self.data[path][offset:offset + size]
+        return walk(self.root, path).data.read(offset, size)
 
     def readdir(self, path, fh):
-        return ['.', '..'] + [x[1:] for x in self.files if x != '/']
+        return ['.', '..'] + list(walk(self.root, path).children)
 
     def readlink(self, path):
-        return self.data[path]
+        data = walk(self.root, path).data
+        return data.read(0, len(data)).decode()
 
     def removexattr(self, path, name):
-        attrs = self.files[path].get('attrs', {})
+        attrs = walk(self.root, path).attrs.get('attrs', {})
 
         try:
             del attrs[name]
@@ -101,54 +115,73 @@ class Memory(LoggingMixIn, Operations):
             pass        # Should return ENOATTR
 
     def rename(self, old, new):
-        self.data[new] = self.data.pop(old)
-        self.files[new] = self.files.pop(old)
+        ''' moves the node to its new parent, taking any children with it'''
+        if new.startswith(old + '/'):
+            raise FuseOSError(EINVAL)
+        old_parent, old_name = walk_parent(self.root, old)
+        new_parent, new_name = walk_parent(self.root, new)
+        node = old_parent.children.get(old_name)
+        if node is None:
+            raise FuseOSError(ENOENT)
+
+        replaced = new_parent.children.get(new_name)
+        if replaced is not None and replaced.children:
+            raise FuseOSError(ENOTEMPTY)
+
+        del old_parent.children[old_name]
+        new_parent.children[new_name] = node
+        if replaced is not None and replaced.is_dir():
+            new_parent.attrs['st_nlink'] -= 1
+        if node.is_dir():
+            old_parent.attrs['st_nlink'] -= 1
+            new_parent.attrs['st_nlink'] += 1
 
     def rmdir(self, path):
-        # with multiple level support, need to raise ENOTEMPTY if contains any files
-        self.files.pop(path)
-        self.files['/']['st_nlink'] -= 1
+        parent, name = walk_parent(self.root, path)
+        if walk(self.root, path).children:
+            raise FuseOSError(ENOTEMPTY)
+        del parent.children[name]
+        parent.attrs['st_nlink'] -= 1
 
     def setxattr(self, path, name, value, options, position=0):
         # Ignore options
-        attrs = self.files[path].setdefault('attrs', {})
+        attrs = walk(self.root, path).attrs.setdefault('attrs', {})
         attrs[name] = value
 
     def statfs(self, path):
         return dict(f_bsize=512, f_blocks=4096, f_bavail=2048)
 
     def symlink(self, target, source):
-        self.files[target] = dict(
+        parent, name = self.new_entry(target)
+        parent.children[name] = Node(dict(
             st_mode=(S_IFLNK | 0o777),
             st_nlink=1,
-            st_size=len(source))
-
-        self.data[target] = source
+            st_size=len(source)), data=PagedFile(source.encode()))
 
     def truncate(self, path, length, fh=None):
-        # make sure extending the file fills in zero bytes
-        self.data[path] = self.data[path][:length].ljust(
-            length, '\x00'.encode('ascii'))
-        self.files[path]['st_size'] = length
+        # extending the file leaves a hole, which reads back as zero bytes
+        node = walk(self.root, path)
+        node.data.truncate(length)
+        node.attrs['st_size'] = length
 
     def unlink(self, path):
-        self.data.pop(path)
-        self.files.pop(path)
+        parent, name = walk_parent(self.root, path)
+        if parent.children.pop(name, None) is None:
+            raise FuseOSError(ENOENT)
 
     def utimens(self, path, times=None):
         now = time()
         atime, mtime = times if times else (now, now)
-        self.files[path]['st_atime'] = atime
-        self.files[path]['st_mtime'] = mtime
+        attrs = walk(self.root, path).attrs
+        attrs['st_atime'] = atime
+        attrs['st_mtime'] = mtime
 
     def write(self, path, data, offset, fh):
-        self.data[path] = (
-            # make sure the data gets inserted at the right offset
-            self.data[path][:offset].ljust(offset, '\x00'.encode('ascii'))
-            + data
-            # and only overwrites the bytes that data is replacing
-            + self.data[path][offset + len(data):])
-        self.files[path]['st_size'] = len(self.data[path])
+        # only the pages the data covers are touched, and any gap between the
+        # old end of the file and offset is left as a hole
+        node = walk(self.root, path)
+        node.data.write(offset, data)
+        node.attrs['st_size'] = len(node.data)
         return len(data)
 
 
@@ -156,7 +189,11 @@ if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('mount')
+    parser.add_argument('--log-every', type=int, default=0,
+                        help='log one in every N calls of each operation')
     args = parser.parse_args()
 
-    logging.basicConfig(level=logging.DEBUG)
-    fuse = FUSE(Memory(), args.mount, foreground=True)
+    logging.basicConfig(level=logging.DEBUG if args.log_every else logging.WARNING)
+    fs = Memory()
+    fs.log_every = args.log_every
+    fuse = FUSE(fs, args.mount, foreground=True)
@@ -0,0 +1,154 @@
+''' Per-operation counters and latency histograms, readable through a
+synthetic /.stats file in the mounted tree '''
+import json
+import logging
+import os
+import threading
+
+from errno import EACCES, ENODATA
+from stat import S_IFREG
+from time import perf_counter, time
+
+from fuse import FuseOSError
+
+STATS_PATH = '/.stats'
+
+# operations which a read-only file allows
+STATS_READ_OPS = frozenset(('getattr', 'open', 'read', 'release', 'flush', 'fsync', 'access'))
+
+
+class OpStats(object):
+    '''Call count, error count and latency histogram of one operation.
+    Bucket b counts the calls which took less than 2**b microseconds.
+    Calls on many threads add to it at once, so it is updated and read
+    under its own lock.'''
+    __slots__ = ('count', 'errors', 'seconds', 'buckets', 'lock')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.buckets = [0] * 32
+        self.lock = threading.Lock()
+
+    def add(self, elapsed, failed):
+        ''' records one call, returning how many there have been'''
+        bucket = min(int(elapsed * 1e6).bit_length(), 31)
+        with self.lock:
+            self.count += 1
+            self.errors += failed
+            self.seconds += elapsed
+            self.buckets[bucket] += 1
+            return self.count
+
+    def percentile(self, pct):
+        ''' upper bound, in microseconds, of the bucket holding the pct
+        percentile call '''
+        rank = max(-(-self.count * pct // 100), 1)
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return 2 ** bucket
+        return None
+
+    def as_dict(self):
+        with self.lock:
+            last = max([b for b, count in enumerate(self.buckets) if count] or [0])
+            return dict(count=self.count, errors=self.errors,
+                        mean_us=self.seconds / self.count * 1e6 if self.count else None,
+                        p50_us=self.percentile(50), p99_us=self.percentile(99),
+                        histogram_us=dict((2 ** b, self.buckets[b]) for b in range(last + 1)))
+
+
+class MetricsMixIn(object):
+    '''Takes the place of fuse's LoggingMixIn. Every operation dispatched by
+    FUSE is counted and timed, and /.stats reads back the numbers as JSON.
+
+    Logging is off unless log_every is set, in which case one call in every
+    log_every is logged, with its arguments, result and latency.
+    Operations called directly on the object, rather than through FUSE, are
+    not counted.
+    '''
+
+    log = logging.getLogger('fuse.metrics')
+    log_every = 0
+    # guards creating op_stats and adding operations to it
+    op_stats_lock = threading.Lock()
+    op_stats = None
+    mount_time = None
+    stats_data = None
+
+    def __call__(self, op, path, *args):
+        if path == STATS_PATH:
+            return self.stats_file_op(op, *args)
+
+        op_stats = self.get_op_stats(op)
+
+        failed = True
+        ret = None
+        start = perf_counter()
+        try:
+            ret = super(MetricsMixIn, self).__call__(op, path, *args)
+            failed = False
+            if op == 'readdir' and path == '/':
+                ret = list(ret) + [STATS_PATH[1:]]
+            return ret
+        except OSError as e:
+            ret = e
+            raise
+        finally:
+            elapsed = perf_counter() - start
+            count = op_stats.add(elapsed, failed)
+            if self.log_every and count % self.log_every == 0:
+                self.log.debug('%s %s %r -> %r in %.1fus', op, path, args,
+                               ret, elapsed * 1e6)
+
+    def get_op_stats(self, op):
+        ''' returns the OpStats of op, creating the table of them on the first
+        call and an entry for op on its first call'''
+        stats = self.op_stats
+        op_stats = stats.get(op) if stats is not None else None
+        if op_stats is None:
+            with self.op_stats_lock:
+                if self.op_stats is None:
+                    self.op_stats = dict()
+                    self.mount_time = time()
+                op_stats = self.op_stats.setdefault(op, OpStats())
+        return op_stats
+
+    def extra_stats(self):
+        ''' other counters shown in /.stats, such as block I/O '''
+        return dict()
+
+    def render_stats(self):
+        with self.op_stats_lock:
+            stats = list((self.op_stats or {}).items())
+        report = dict(ops=dict((op, op_stats.as_dict()) for op, op_stats in stats))
+        report.update(self.extra_stats())
+        self.stats_data = (json.dumps(report, indent=2, sort_keys=True) + '\n').encode('ascii')
+        return self.stats_data
+
+    def stats_file_op(self, op, *args):
+        ''' serves /.stats. Its contents are taken when it is looked up, so a
+        reader sees a consistent snapshot of the size it was given. '''
+        if op not in STATS_READ_OPS:
+            if op == 'getxattr':
+                raise FuseOSError(ENODATA)
+            if op == 'listxattr':
+                return []
+            raise FuseOSError(EACCES)
+
+        if op == 'getattr':
+            now = time()
+            return dict(st_mode=(S_IFREG | 0o444), st_nlink=1, st_size=len(self.render_stats()),
+                        st_ctime=self.mount_time or now, st_mtime=now, st_atime=now)
+        if op == 'open':
+            if args[0] & os.O_ACCMODE != os.O_RDONLY:
+                raise FuseOSError(EACCES)
+            return 0
+        if op == 'read':
+            size, offset = args[0], args[1]
+            data = self.stats_data or self.render_stats()
+            return data[offset:offset + size]
+        return 0
@@ -0,0 +1,71 @@
+''' Sparse, page-backed file contents for the in-memory file systems '''
+
+PAGE_SIZE = 4096
+
+
+class PagedFile(object):
+    '''The contents of a file as fixed-size pages, keyed by page index.
+
+    A write only changes the pages it covers. Pages which have never been
+    written, such as the gap left by a write past the end or by extending
+    the file with truncate, are holes: they are not stored and read back as
+    zeros.
+    '''
+
+    def __init__(self, data=b''):
+        self.pages = dict()
+        self.size = 0
+        if data:
+            self.write(0, data)
+
+    def __len__(self):
+        return self.size
+
+    def read(self, offset, size):
+        ''' returns up to size bytes from offset, stopping at the end of the file'''
+        end = min(offset + size, self.size)
+        if offset >= end:
+            return bytes()
+
+        out = bytearray(end - offset)
+        for index in range(offset // PAGE_SIZE, (end - 1) // PAGE_SIZE + 1):
+            page = self.pages.get(index)
+            if page is None:
+                continue
+            page_start = index * PAGE_SIZE
+            start = max(offset, page_start)
+            stop = min(end, page_start + PAGE_SIZE)
+            out[start - offset:stop - offset] = page[start - page_start:stop - page_start]
+        return bytes(out)
+
+    def write(self, offset, data):
+        ''' writes data at offset, growing the file if it ends past the end.
+        Returns the number of bytes written.'''
+        end = offset + len(data)
+        if not data:
+            return 0
+
+        data = memoryview(data)
+        for index in range(offset // PAGE_SIZE, (end - 1) // PAGE_SIZE + 1):
+            page = self.pages.get(index)
+            if page is None:
+                page = self.pages[index] = bytearray(PAGE_SIZE)
+            page_start = index * PAGE_SIZE
+            start = max(offset, page_start)
+            stop = min(end, page_start + PAGE_SIZE)
+            page[start - page_start:stop - page_start] = data[start - offset:stop - offset]
+
+        self.size = max(self.size, end)
+        return len(data)
+
+    def truncate(self, length):
+        ''' cuts the file down to length bytes, or extends it with a hole'''
+        if length < self.size:
+            keep = -(-length // PAGE_SIZE)
+            for index in [index for index in self.pages if index >= keep]:
+                del self.pages[index]
+            # the bytes past the new end must read as zeros if it grows again
+            last = self.pages.get(keep - 1)
+            if last is not None and length % PAGE_SIZE:
+                last[length % PAGE_SIZE:] = bytes(PAGE_SIZE - length % PAGE_SIZE)
+        self.size = length
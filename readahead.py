@@ -0,0 +1,90 @@
+''' Read-ahead for files which are being read sequentially '''
+import threading
+
+from collections import OrderedDict
+
+from constants import READAHEAD_MIN_BLOCKS, READAHEAD_MAX_BLOCKS, READAHEAD_STREAMS
+
+
+class Stream(object):
+    '''What is known about how one file is being read: where the next read
+    starts if it is sequential, the current window, and the bytes of the
+    file from start which were fetched ahead of the reader.'''
+    __slots__ = ('next_offset', 'window', 'start', 'data')
+
+    def __init__(self):
+        self.next_offset = 0
+        self.window = 0
+        self.start = 0
+        self.data = b''
+
+
+class ReadAhead(object):
+    '''Keeps a read-ahead buffer for each of the files read most recently.
+
+    A read which starts where the last one ended is sequential. Each
+    sequential read which misses the buffer doubles the window, and the
+    caller fetches that many blocks past the read into a new buffer.
+    Any other read closes the window. Writes to a file must invalidate it.
+    '''
+
+    def __init__(self, block_size, min_window=READAHEAD_MIN_BLOCKS,
+                 max_window=READAHEAD_MAX_BLOCKS, streams=READAHEAD_STREAMS):
+        self.block_size = block_size
+        self.min_window = min_window
+        self.max_window = max_window
+        self.size = streams
+        self.streams = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, file_num, offset, end):
+        ''' returns bytes offset to end of the file from its buffer, or None
+        if they are not all buffered'''
+        with self.lock:
+            stream = self.streams.get(file_num)
+            if stream is None or offset < stream.start \
+                    or end > stream.start + len(stream.data):
+                return None
+            self.streams.move_to_end(file_num)
+            stream.next_offset = end
+            self.hits += 1
+            return bytes(stream.data[offset - stream.start:end - stream.start])
+
+    def window(self, file_num, offset, end):
+        ''' records a read which missed the buffer, returning how many blocks
+        past it should be fetched'''
+        with self.lock:
+            self.misses += 1
+            stream = self.streams.get(file_num)
+            if stream is None:
+                stream = self.streams[file_num] = Stream()
+                while len(self.streams) > self.size:
+                    self.streams.popitem(last=False)
+            else:
+                self.streams.move_to_end(file_num)
+
+            if offset == stream.next_offset:
+                stream.window = min(max(stream.window * 2, self.min_window), self.max_window)
+            else:
+                stream.window = 0
+            stream.next_offset = end
+            stream.data = b''
+            return stream.window
+
+    def fill(self, file_num, start, data):
+        ''' keeps data, the bytes of the file from start, as its buffer'''
+        with self.lock:
+            stream = self.streams.get(file_num)
+            if stream is not None:
+                stream.start = start
+                stream.data = data
+
+    def invalidate(self, file_num):
+        with self.lock:
+            self.streams.pop(file_num, None)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, streams=len(self.streams))
@@ -0,0 +1,102 @@
+''' Locks shared by the SmallDisk layers when FUSE dispatches on many threads '''
+import threading
+
+from contextlib import contextmanager
+from functools import wraps
+
+
+def synchronized(method):
+    '''Runs a method while holding the object's lock, which must be
+    reentrant if synchronized methods call each other'''
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class RWLock(object):
+    '''Lets any number of readers, or a single writer, hold the lock.
+
+    Waiting writers are preferred over new readers, so a steady stream of
+    readers cannot starve them. The lock is reentrant: a thread holding it
+    may take it again in either mode, except that a reader cannot upgrade to
+    a writer.
+    '''
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        # thread id: how many times that thread holds the read lock
+        self.readers = dict()
+        self.writer = None
+        self.write_depth = 0
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me or me in self.readers:
+                self.readers[me] = self.readers.get(me, 0) + 1
+                return
+            while self.writer is not None or self.waiting_writers:
+                self.cond.wait()
+            self.readers[me] = 1
+
+    def release_read(self):
+        me = threading.get_ident()
+        with self.cond:
+            depth = self.readers[me] - 1
+            if depth:
+                self.readers[me] = depth
+                return
+            del self.readers[me]
+            if not self.readers:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.write_depth += 1
+                return
+            if me in self.readers:
+                raise RuntimeError('A read lock cannot be upgraded to a write lock')
+            self.waiting_writers += 1
+            try:
+                while self.writer is not None or self.readers:
+                    self.cond.wait()
+            finally:
+                self.waiting_writers -= 1
+            self.writer = me
+            self.write_depth = 1
+
+    def release_write(self):
+        with self.cond:
+            self.write_depth -= 1
+            if not self.write_depth:
+                self.writer = None
+                self.cond.notify_all()
+
+    @contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+    def locked(self, mode):
+        ''' returns the context manager for mode, 'read' or 'write' '''
+        if mode == 'write':
+            return self.writing()
+        if mode == 'read':
+            return self.reading()
+        raise ValueError('Unknown lock mode: ' + str(mode))
@@ -1,100 +1,219 @@
 #!/usr/bin/env python
 from __future__ import print_function, absolute_import, division
-from typing import Tuple
-from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
+from fuse import FUSE, FuseOSError, Operations
 
 import logging
+import threading
 
+from functools import wraps
 from time import time
 from math import ceil
 
-from errno import ENOENT, ENOTEMPTY
-from stat import ST_NLINK, S_IFDIR, S_IFLNK, S_IFREG
-
-from disktools import BLOCK_SIZE, NUM_BLOCKS, bytes_to_int,  int_to_bytes, print_block, read_block, write_block
-from format import create_file_data, format_block, format_dir, path_name_as_bytes, bytes_to_pathname
+from errno import EEXIST, ENOENT, ENOTDIR, ENOTEMPTY
+from stat import ST_NLINK, S_IFDIR, S_IFLNK, S_IFREG, S_ISDIR
+
+from allocator import BitmapAllocator
+from cache import BlockCache
+from checkpoint import Checkpoint
+from codec import METADATA, STAT, MAP_HEADER, EXTENT, DIRENT, EXTENT_LOC, MAP_EXTENT_LOC, \
+    INLINE_DATA_LOC, pack_extents_into, unpack_extents, unpack_dirents
+from dirents import Directory
+from extents import ExtentMap
+from journal import Journal, transactional
+from metrics import MetricsMixIn
+from readahead import ReadAhead
+from rwlock import RWLock
+from timestamps import Timestamps
+from disktools import BlockDevice
+from format import create_metadata_block, format_dir, bytes_to_pathname, path_name_as_bytes
 from constants import *
 
 
-class SmallDisk(LoggingMixIn, Operations):
-    def get_first_file(self, root_num):
-        ''' returns the block number of the file pointed to by the current file '''
-        root = read_block(root_num)
-        fh_b = root[NEXT_FILE_LOC: NEXT_FILE_LOC + NEXT_FILE_SIZE]
-        return bytes_to_int(fh_b)
-
-    def get_block(self, block_num):
-        ''' returns the free/used block pointed to by the current file. 
-        For files, this is the first data block. For the root, 
-        this is the first free block '''
-        current_block = read_block(block_num)
-        b_block_num = current_block[NEXT_BLOCK_LOC: NEXT_BLOCK_LOC+NEXT_BLOCK_SIZE]
-        return bytes_to_int(b_block_num)
+def locked(namespace='read', file=None):
+    '''Holds the namespace lock, and then the lock of the file at path if
+    file is given, in the given modes for the whole of an operation.
+    Outside @transactional, so the transaction commits before they are released.'''
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, path, *args, **kwargs):
+            with self.namespace_lock.locked(namespace):
+                if file is None:
+                    return method(self, path, *args, **kwargs)
+                with self.file_lock(self.find_file_num(path)).locked(file):
+                    return method(self, path, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SmallDisk(MetricsMixIn, Operations):
+    '''FUSE file system kept in a disk image.
+
+    Operations may run on many threads at once. Locks are always taken in
+    this order, and each is held for the whole operation unless noted:
+
+    1. namespace lock: written by create, unlink, mkdir, rmdir and destroy,
+       which change directory entries. Read by every other operation that
+       looks up a path.
+    2. file lock, one per metadata block: written by write, truncate and
+       utimens, and by flush_times while it writes back the file's
+       timestamps. Read by read, which never writes the metadata block:
+       the access times it sets are held in Timestamps until a writer or
+       flush_times writes them. Reads of different files, or of the same
+       file, run in parallel.
+    3. allocator lock, held by each BitmapAllocator call.
+    4. cache lock, held by each BlockCache call.
+
+    The journal's commit condition is only held while queueing a
+    transaction, never while waiting for one of the locks above.
+    Concurrent writes to different files may commit a shared bitmap block
+    in either transaction, with bits set for blocks the other has not
+    committed yet, so a crash can leave a block marked used that no file
+    holds. Freed blocks are only cleared in the bitmap once the transaction
+    freeing them has committed, so never a block in use marked free.
+    '''
+
+    def __init__(self, disk_name=DISK_NAME, backend='pread', cache_size=CACHE_BLOCKS,
+                 io_threads=IO_THREADS, atime='relatime', lazytime=False):
+        # the disk image is opened once here and held until unmount.
+        # All block traffic goes through the write-back cache, and metadata
+        # writes are committed through the journal.
+        self.disk = Journal(BlockCache(
+            BlockDevice(disk_name, backend, io_threads=io_threads), cache_size))
+
+        # the geometry comes from the superblock of the mounted disk
+        sb = self.disk.superblock
+        self.block_size = sb.block_size
+        self.num_blocks = sb.num_blocks
+        self.root_loc = sb.root_loc
+        # how many extents fit in a metadata block, and in each map block
+        self.inline_extents = (self.block_size - EXTENT_LOC) // EXTENT.size
+        self.map_block_extents = (self.block_size - MAP_EXTENT_LOC) // EXTENT.size
+        # the largest file kept inline in its metadata block
+        self.inline_size = self.block_size - INLINE_DATA_LOC
+        self.dirents_per_block = self.block_size // DIRENT.size
+        self.readahead = ReadAhead(self.block_size)
+
+        self.namespace_lock = RWLock()
+        self.file_locks = dict()
+        self.file_locks_guard = threading.Lock()
+
+        # after a clean unmount, the directories loaded before it and the free
+        # block count come from the checkpoint in one read. Otherwise directory
+        # entries are loaded the first time a path goes through them.
+        checkpoint = Checkpoint.read(self.disk.device, self.disk.mounted_sequence)
+        self.checkpoint_loaded = checkpoint is not None
+        if checkpoint is None:
+            checkpoint = Checkpoint(None, 0)
+        self.extent_maps = checkpoint.extent_maps
+        self.directories = checkpoint.directories
+        self.allocator = BitmapAllocator(self.disk, sb, checkpoint.free_count, checkpoint.cursor)
+
+        self.timestamps = Timestamps(atime, lazytime)
+        self.stopping = threading.Event()
+        if lazytime:
+            flusher = threading.Thread(target=self.flush_times_periodically)
+            flusher.daemon = True
+            flusher.start()
+
+    @locked(namespace='write')
+    def destroy(self, path):
+        ''' writes any pending timestamps and empties the journal, then
+        checkpoints the loaded directories so the next mount need not read
+        them again'''
+        self.stopping.set()
+        self.flush_times()
+        # bits released by abandoned transactions may not be written yet
+        with self.disk.transaction():
+            self.allocator.write_back()
+        self.disk.empty()
+        Checkpoint(self.allocator.free_count, self.allocator.cursor, self.directories,
+                   self.extent_maps).write(self.disk.device, self.disk.marker_sequence)
+        self.disk.close()
+
+    def file_lock(self, file_num):
+        ''' returns the lock of the file with metadata in block file_num'''
+        with self.file_locks_guard:
+            lock = self.file_locks.get(file_num)
+            if lock is None:
+                lock = self.file_locks[file_num] = RWLock()
+            return lock
+
+    def flush(self, path, fh):
+        self.flush_times()
+        self.disk.flush()
+        return 0
+
+    def fsync(self, path, datasync, fh):
+        self.flush_times()
+        self.disk.sync()
+        return 0
+
+    def release(self, path, fh):
+        self.disk.flush()
+        return 0
+
+    def extra_stats(self):
+        return dict(device=self.disk.device.stats(), cache=self.disk.stats(),
+                    readahead=self.readahead.stats(), timestamps=self.timestamps.stats(),
+                    free_blocks=self.allocator.free_count,
+                    checkpoint_loaded=self.checkpoint_loaded)
 
     def get_fh(self):
-        root = read_block(ROOT_LOC)
-        return root[FH_LOC]
+        return METADATA.get(self.disk.view_block(self.root_loc), 'fh')
 
     def get_file_size(self, file_num):
-        file_data = read_block(file_num)
-        return bytes_to_int(file_data[FILE_DATA_LOC + ST_SIZE_LOC: FILE_DATA_LOC + ST_SIZE_LOC + ST_SIZE_SIZE])
+        return METADATA.get(self.disk.view_block(file_num), 'st_size')
 
+    @locked(namespace='write')
+    @transactional
     def create(self, path, mode):
         ''' creates a file at path with no data blocks, and adds it to the
-        linked list of files. '''
-        file_data = create_file_data(path, (S_IFREG | mode))
-
-        next_file = int_to_bytes(NUM_BLOCKS, NEXT_FILE_SIZE)
-        next_block = int_to_bytes(NUM_BLOCKS, NEXT_BLOCK_SIZE)
-
-        data = next_file + next_block + file_data
+        entries of its directory. '''
+        dir_num, name = self.find_new_entry(path)
+        data = create_metadata_block(self.block_size, name, (S_IFREG | mode))
 
         # Finds the next free block, updating both self and file.
         next_free_block = self.find_free_block()
-        write_block(next_free_block, data)
+        self.disk.write_block(next_free_block, data)
 
         # increments fh in the root.
         fh = self.get_fh()
         fh += 1
-        self.convert_bytes_and_update_block(ROOT_LOC, FH_LOC, fh, FH_SIZE)
+        self.update_fields(self.root_loc, fh=fh)
 
-        # adds this file to the end of the file linked list
-        last_file = self.find_last_file()
-        self.convert_bytes_and_update_block(
-            last_file, NEXT_FILE_LOC, next_free_block, NEXT_FILE_SIZE)
+        self.add_entry(dir_num, name, next_free_block)
 
         return fh
 
+    @locked(file='write')
+    @transactional
     def utimens(self, path, times=None):
         now = int(time())
-
-        times = tuple(int(t) for t in times)
-        atime, mtime = times if times else (now, now)
+        atime, mtime = (int(t) for t in times) if times else (now, now)
 
         file_num = self.find_file_num(path)
+        self.set_times(file_num, st_atime=atime, st_mtime=mtime, st_ctime=now)
 
-        self.convert_bytes_and_update_block(
-            file_num, MTIME_LOC, mtime, ST_MTIME_SIZE)
-        self.convert_bytes_and_update_block(
-            file_num, ATIME_LOC, atime, ST_ATIME_SIZE)
-
+    @locked(namespace='write')
+    @transactional
     def unlink(self, path):
-        (prev_block_num, file_block_num, next_block_num) = self.find_file_tuple(path)
-
-        if (prev_block_num == file_block_num or prev_block_num == next_block_num or file_block_num == next_block_num):
-            raise IOError("prev, current, or next block equal")
-
-        # removes the current file from the file linked list by making the previous file
-        # point to the next file.
-        self.convert_bytes_and_update_block(
-            prev_block_num, NEXT_FILE_LOC, next_block_num, NEXT_FILE_SIZE)
+        dir_path, name = self.split_path(path)
+        dir_num = self.find_file_num(dir_path)
+        file_block_num = self.get_directory(dir_num).get(name)
+        if file_block_num is None:
+            raise FuseOSError(ENOENT)
 
-        file_blocks = self.get_all_file_blocks(file_block_num)
-        file_blocks.append(file_block_num)
+        self.remove_entry(dir_num, name)
 
-        while(file_blocks):
-            self.format_block(file_blocks.pop())
+        extent_map = self.get_extent_map(file_block_num)
+        self.allocator.free(extent_map.allocated_blocks() + extent_map.map_blocks + [file_block_num])
+        del self.extent_maps[file_block_num]
+        self.directories.pop(file_block_num, None)
+        self.timestamps.discard(file_block_num)
+        self.readahead.invalidate(file_block_num)
+        self.file_locks.pop(file_block_num, None)
 
+    @locked()
     def getattr(self, path, fh=None):
         file_block_num = self.find_file_num(path)
         return self.get_file_description(file_block_num)
@@ -112,65 +231,159 @@ class SmallDisk(LoggingMixIn, Operations):
         attrs = self.getattr(path)
         return attrs.keys()
 
-    def get_all_filenames(self, path) -> list:
-        ''' returns a list of all filenames for the current directory (.,.. excl)'''
-        filenames = []
-
-        # files will always come after their directory
-        dir_num = self.find_file_num(path)
-
-        fnum = self.get_first_file(dir_num)
-        while(fnum < NUM_BLOCKS):
-            fname = self.get_file_name(fnum)
-
-            if len(fname.split(path)) == 2:
-                filenames.append('/' + fname.split('/')[-1])
-
-            fnum = self.find_next_file(fnum)
-
-        return filenames
-
-    def get_all_file_blocks(self, file_num):
-        ''' returns a list of the block numbers containing file data for the input file'''
-        block_nums = []
-        b_num = self.get_block(file_num)
-
-        while b_num < NUM_BLOCKS:
-            block_nums.append(b_num)
-            b_num = self.get_block(b_num)
-
-        return block_nums
+    def get_extent_map(self, file_num):
+        ''' returns the extent map of the input file, loading it the first time'''
+        self.forget_on_abort(file_num)
+        extent_map = self.extent_maps.get(file_num)
+        if extent_map is None:
+            extent_map = self.load_extent_map(file_num)
+            self.extent_maps[file_num] = extent_map
+        return extent_map
+
+    def forget_on_abort(self, file_num):
+        ''' has the file's extent map and entries dropped if the current
+        transaction is abandoned, since the operation may have changed them.
+        They are loaded again from the restored blocks when next needed.'''
+        self.disk.on_abort(lambda: self.forget(file_num), key=file_num)
+
+    def forget(self, file_num):
+        self.extent_maps.pop(file_num, None)
+        self.directories.pop(file_num, None)
+
+    def load_extent_map(self, file_num):
+        ''' reads the extents from the metadata block, followed by any map blocks'''
+        meta_block = self.disk.view_block(file_num)
+        extents = unpack_extents(
+            meta_block, EXTENT_LOC, METADATA.get(meta_block, 'extent_count'))
+        map_blocks = []
+
+        map_num = METADATA.get(meta_block, 'next_block')
+        while map_num != NO_BLOCK:
+            map_blocks.append(map_num)
+            map_block = self.disk.view_block(map_num)
+            extents += unpack_extents(
+                map_block, MAP_EXTENT_LOC, MAP_HEADER.get(map_block, 'extent_count'))
+            map_num = MAP_HEADER.get(map_block, 'next_block')
+
+        return ExtentMap(extents, map_blocks)
+
+    def save_extent_map(self, file_num, extent_map):
+        ''' writes back the part of the extent map changed since it was last saved,
+        growing or shrinking the chain of map blocks to fit.
+
+        Area 0 is the metadata block, and area n is map block n - 1.'''
+        extents = extent_map.extents
+        map_blocks = extent_map.map_blocks
+        num_map_blocks = max(
+            ceil((len(extents) - self.inline_extents) / self.map_block_extents), 0)
+
+        if extent_map.dirty_from < self.inline_extents:
+            first_area = 0
+        else:
+            first_area = 1 + (extent_map.dirty_from - self.inline_extents) // self.map_block_extents
+
+        # the area at the old or new end of the chain has its next pointer changed
+        if num_map_blocks > len(map_blocks):
+            first_area = min(first_area, len(map_blocks))
+            map_blocks.extend(self.allocator.allocate_blocks(num_map_blocks - len(map_blocks)))
+        elif num_map_blocks < len(map_blocks):
+            first_area = min(first_area, num_map_blocks)
+            self.allocator.free(map_blocks[num_map_blocks:])
+            del map_blocks[num_map_blocks:]
+
+        for area in range(first_area, num_map_blocks + 1):
+            next_map = map_blocks[area] if area < num_map_blocks else NO_BLOCK
+
+            if area == 0:
+                inline = extents[:self.inline_extents]
+                block = self.disk.read_block(file_num)
+                METADATA.set(block, 'next_block', next_map)
+                METADATA.set(block, 'extent_count', len(inline))
+                pack_extents_into(block, EXTENT_LOC, inline)
+                self.disk.write_block(file_num, block)
+            else:
+                start = self.inline_extents + (area - 1) * self.map_block_extents
+                in_block = extents[start:start + self.map_block_extents]
+                block = bytearray(self.block_size)
+                MAP_HEADER.pack_into(block, next_file=NO_BLOCK, next_block=next_map,
+                                     extent_count=len(in_block))
+                pack_extents_into(block, MAP_EXTENT_LOC, in_block)
+                self.disk.write_block(map_blocks[area - 1], block)
 
-    def get_file_name(self, file_num):
-        ''' returns the name of the file with metadata in block file_num'''
-        file_data = read_block(file_num)
-        name_data = file_data[NAME_LOC:NAME_LOC+NAME_SIZE]
-        return bytes_to_pathname(name_data)
+        extent_map.dirty_from = len(extents)
 
+    @locked(file='read')
     def read(self, path, size, offset, fh):
         file_num = self.find_file_num(path)
-        return self.get_current_file_data(file_num)[offset:offset + size]
+        data = self.read_file_range(file_num, offset, size)
 
+        # only the file's read lock is held, so the access time is recorded
+        # in memory, for the next writer of the file or flush_times to write
+        now = int(time())
+        if self.timestamps.atime_due(self.get_file_description(file_num), now):
+            self.timestamps.record(file_num, dict(st_atime=now))
+        return data
+
+    def read_file_range(self, file_num, offset, size):
+        ''' reads size bytes from offset, visiting only the blocks which cover
+        the request and stopping at the end of the file. Sequential reads are
+        served from the read-ahead buffer, and fetch blocks past the request
+        into it when they miss. Inline data comes from the metadata block.'''
+        meta_block = self.disk.view_block(file_num)
+        file_size = METADATA.get(meta_block, 'st_size')
+        end = min(offset + size, file_size)
+        if offset >= end:
+            return bytes()
+        if METADATA.get(meta_block, 'flags') & INLINE_DATA:
+            return bytes(meta_block[INLINE_DATA_LOC + offset:INLINE_DATA_LOC + end])
+
+        data = self.readahead.read(file_num, offset, end)
+        if data is not None:
+            return data
+
+        first_index = offset // self.block_size
+        last_index = (end - 1) // self.block_size
+        window = self.readahead.window(file_num, offset, end)
+        if window:
+            last_index = min(last_index + window, (file_size - 1) // self.block_size)
+
+        data = self.read_file_blocks(file_num, first_index, last_index + 1 - first_index)
+        start = first_index * self.block_size
+        if window:
+            self.readahead.fill(file_num, start, memoryview(data)[:file_size - start])
+        return bytes(memoryview(data)[offset - start:end - start])
+
+    def read_file_blocks(self, file_num, first_index, count):
+        ''' returns count blocks of the file from first_index, in one buffer'''
+        file_blocks = self.get_extent_map(file_num).blocks(first_index, count)
+
+        # adjacent blocks are fetched together, straight into one buffer.
+        # Holes are never read, they are left as zeros.
+        if NO_BLOCK not in file_blocks:
+            return self.disk.read_blocks(file_blocks)
+
+        data = bytearray(len(file_blocks) * self.block_size)
+        written = [i for i, block_num in enumerate(file_blocks) if block_num != NO_BLOCK]
+        fetched = self.disk.read_blocks([file_blocks[i] for i in written])
+        for n, i in enumerate(written):
+            data[i * self.block_size:(i + 1) * self.block_size] = \
+                fetched[n * self.block_size:(n + 1) * self.block_size]
+        return data
+
+    @locked(namespace='write')
+    @transactional
     def mkdir(self, path, mode):
+        dir_num, name = self.find_new_entry(path)
         new_dir_num = self.find_free_block()
-        format_dir(path, mode, file_num=new_dir_num,
-                   next_free_block=NUM_BLOCKS)
+        format_dir(self.disk, name, mode, file_num=new_dir_num)
 
-        last_file = self.find_last_file()
-        self.convert_bytes_and_update_block(
-            last_file, NEXT_FILE_LOC, new_dir_num, NEXT_FILE_SIZE)
-
-        dir_path = self.get_dir_path(path)
-
-        dir_num = self.find_file_num(dir_path)
+        self.add_entry(dir_num, name, new_dir_num)
         self.change_n_link(dir_num)
 
-    def get_dir_path(self, path):
-        ''' gets the path of the parent directory from the input path '''
-        dir_path = path.rsplit('/', 1)[0]
-        if not dir_path:
-            dir_path = '/'
-        return dir_path
+    def split_path(self, path):
+        ''' splits path into the path of its directory and its own name '''
+        dir_path, name = path.rsplit('/', 1)
+        return dir_path or '/', name
 
     def change_n_link(self, dir_num: int, positive=True):
         ''' changes the n_links for the input directory.
@@ -179,218 +392,402 @@ class SmallDisk(LoggingMixIn, Operations):
             bool Positive: true for increment, false for decrement '''
         direction = 1 if positive else -1
 
-        root = read_block(dir_num)
-        st_n_link = bytes_to_int(
-            root[ST_N_LINKS_LOC: ST_N_LINKS_LOC+ST_NLINKS_SIZE])
+        st_n_link = METADATA.get(self.disk.view_block(dir_num), 'st_nlink')
         st_n_link += 1 * direction
-        self.convert_bytes_and_update_block(
-            ROOT_LOC, ST_N_LINKS_LOC, st_n_link, ST_NLINKS_SIZE)
+        self.update_fields(dir_num, st_nlink=st_n_link)
 
+    @locked()
     def readdir(self, path, fh=None):
-        return ['.', '..'] + [x[1:] for x in self.get_all_filenames(path)]
+        return ['.', '..'] + self.get_directory(self.find_file_num(path)).names
 
+    @locked(namespace='write')
+    @transactional
     def rmdir(self, path):
         ''' removes directory if it does not contain files, otherwise raises error'''
-        if len(self.readdir(path)) > 2:
+        if len(self.get_directory(self.find_file_num(path))):
             raise FuseOSError(ENOTEMPTY)
         else:
-            parent_path = self.get_dir_path(path)
+            parent_path, _ = self.split_path(path)
             self.unlink(path)
             parent_num = self.find_file_num(parent_path)
-            self.change_n_link(parent_num)
+            self.change_n_link(parent_num, positive=False)
 
     def get_file_description(self, file_meta_block_num):
-        ''' returns the description of the file from its metadata as a dictionary'''
-        meta_block = read_block(file_meta_block_num)
-        file_details = dict()
-
-        details = ["st_mode", "st_uid", "st_gid", "st_nlink",
-                   "st_size", "st_ctime", "st_mtime", "st_atime"]
-
-        locations = [2, 4, 6, 7, 9, 13, 17, 21]
-
-        prev_end = FILE_DATA_LOC
-        for (i, detail) in enumerate(details):
-            end = locations[i] + FILE_DATA_LOC
-            file_details[detail] = bytes_to_int(meta_block[prev_end:end])
-            prev_end = end
-
-        return file_details
-
-    def get_current_file_data(self, file_num):
-        ''' Fetches all the data currently stored in the input file'''
-        file_blocks = self.get_all_file_blocks(file_num)
-
-        current_file_data = b''
-
-        for block_num in file_blocks:
-            current_file_data += read_block(
-                block_num)[NEXT_BLOCK_LOC + NEXT_BLOCK_SIZE:]
-
-        return current_file_data
-
-    def write(self, path, data, offset, fh, length=None):
+        ''' returns the description of the file from its metadata as a dictionary,
+        with any timestamps not yet written back'''
+        stat = STAT.unpack(self.disk.view_block(file_meta_block_num))
+        stat.update(self.timestamps.pending(file_meta_block_num))
+        return stat
+
+    @locked(file='write')
+    @transactional
+    def write(self, path, data, offset, fh):
         ''' writes the data to file stored at path '''
         file_num = self.find_file_num(path)
-        file_blocks = self.get_all_file_blocks(file_num)
+        self.write_file_range(file_num, offset, data)
+        now = int(time())
+        self.set_times(file_num, st_mtime=now, st_ctime=now)
+        return len(data)
 
+    @locked(file='write')
+    @transactional
+    def truncate(self, path, length, fh=None):
+        file_num = self.find_file_num(path)
         file_size = self.get_file_size(file_num)
 
-        # fetches only the data that is real data, removing padding of rest of last block.
-        current_file_data = self.get_current_file_data(file_num)
-        current_file_data = current_file_data[:file_size]
-
-        if length == None:
-            # length == None indicates it is a regular write call
-            new_data = (current_file_data[:offset].ljust(offset, '\x00'.encode('ascii'))
-                        + data
-                        # and only overwrites the bytes that data is replacing
-                        + current_file_data[offset + len(data):])
-        else:  # truncate
-            # make sure extending the file fills in zero bytes
-            new_data = current_file_data[:length].ljust(
-                length, '\x00'.encode('ascii'))
-
-        new_file_size = len(new_data)
-
-        num_blocks_needed = max(ceil(new_file_size / EFFECTIVE_BLOCK_SIZE), 1)
-
-        if len(file_blocks) != num_blocks_needed:
-            if len(file_blocks) < num_blocks_needed:
-                while len(file_blocks) < num_blocks_needed:
-                    try:
-                        file_blocks.append(self.find_free_block())
-                    except:
-                        if not file_blocks:
-                            # Only got a metadata block and not a data block.
-                            # Unlink metadata block, no room for file.
-                            self.unlink(file_num)
-                        raise IOError("No free blocks remaining")
+        self.readahead.invalidate(file_num)
+        now = int(time())
+        self.set_times(file_num, st_mtime=now, st_ctime=now)
+        if length == file_size:
+            return
+        if length <= self.inline_size and (length or self.is_inline(file_num)):
+            # a file cut down to fit its metadata block moves back inline
+            self.truncate_inline(file_num, length)
+            return
+        if self.is_inline(file_num):
+            self.move_inline_data(file_num)
+
+        if length > file_size:
+            # the new part of the file is a hole, which reads back as zeros
+            extent_map = self.get_extent_map(file_num)
+            extent_map.append_hole(ceil(length / self.block_size) - len(extent_map))
+            self.save_extent_map(file_num, extent_map)
+            self.set_file_size(file_num, length)
+        elif length < file_size:
+            self.shrink_file(file_num, length)
+
+    def write_file_range(self, file_num, offset, data):
+        ''' writes data into the file at offset, touching only the blocks which
+        the write covers. Blocks are only allocated for the file blocks the data
+        lands in, so a gap between the end of the file and offset is left as a
+        hole. Existing blocks only partly covered are read, modified and
+        written back. Small files are kept inline in their metadata block
+        until a write takes them past it.'''
+        if not data:
+            return
+
+        self.readahead.invalidate(file_num)
+        file_size = self.get_file_size(file_num)
+        end = offset + len(data)
+        inline = self.is_inline(file_num)
+        if end <= self.inline_size and (inline or not file_size):
+            self.write_inline(file_num, offset, data)
+            return
+        if inline:
+            # the file no longer fits in its metadata block
+            self.move_inline_data(file_num)
+
+        first_index = offset // self.block_size
+        last_index = (end - 1) // self.block_size
+        count = last_index + 1 - first_index
+
+        extent_map = self.get_extent_map(file_num)
+        file_blocks = extent_map.blocks(first_index, count)
+        file_blocks += [NO_BLOCK] * (count - len(file_blocks))
+
+        # holes and blocks past the end of the map are given new blocks,
+        # taken as one contiguous run where possible
+        fresh = [i for i, block_num in enumerate(file_blocks) if block_num == NO_BLOCK]
+        if fresh:
+            new_blocks = self.allocator.allocate_blocks(len(fresh))
+            run_start = 0
+            for n in range(1, len(fresh) + 1):
+                if n == len(fresh) or fresh[n] != fresh[n - 1] + 1:
+                    extent_map.assign(first_index + fresh[run_start], new_blocks[run_start:n])
+                    run_start = n
+            for i, block_num in zip(fresh, new_blocks):
+                file_blocks[i] = block_num
+            self.save_extent_map(file_num, extent_map)
+        fresh = set(fresh)
+
+        data = memoryview(data)
+        whole_blocks = dict()
+
+        for i in range(count):
+            block_start = (first_index + i) * self.block_size
+            start = max(offset, block_start)
+            stop = min(end, block_start + self.block_size)
+            chunk = data[start - offset:stop - offset]
+            block_num = file_blocks[i]
+
+            if stop - start == self.block_size:
+                whole_blocks[block_num] = chunk
+            elif i in fresh:
+                # a new block, zero either side of the write
+                whole_blocks[block_num] = bytes(start - block_start) + bytes(chunk) + \
+                    bytes(block_start + self.block_size - stop)
             else:
-                while len(file_blocks) > num_blocks_needed:
-                    self.format_block(file_blocks.pop())
-
-        NO_NEXT_FILE = int_to_bytes(NUM_BLOCKS, NEXT_FILE_SIZE)
-
-        for i in range(num_blocks_needed):
-            data_to_write = new_data[:EFFECTIVE_BLOCK_SIZE].ljust(
-                EFFECTIVE_BLOCK_SIZE, '\x00'.encode('ascii'))
-            new_data = new_data[EFFECTIVE_BLOCK_SIZE:]
-
-            next_block = NUM_BLOCKS if i == num_blocks_needed - \
-                1 else file_blocks[i+1]
-            b_next_block = int_to_bytes(next_block, NEXT_BLOCK_SIZE)
-            write_block(file_blocks[i], NO_NEXT_FILE +
-                        b_next_block + data_to_write)
-
-        # update file size in metadata
-        self.convert_bytes_and_update_block(
-            file_num, FILE_DATA_LOC + ST_SIZE_LOC, new_file_size, ST_SIZE_SIZE)
-
-        # update file first block in metadata
-        self.convert_bytes_and_update_block(
-            file_num, NEXT_BLOCK_LOC, file_blocks[0], NEXT_BLOCK_SIZE)
-
-        if data != None:
-            return len(data)
+                # partial edge block, keep the bytes either side of the write
+                self.update_block(block_num, start - block_start, chunk)
+
+        # adjacent blocks are written together
+        self.disk.write_blocks(whole_blocks)
+
+        if end > file_size:
+            self.set_file_size(file_num, end)
+
+    def shrink_file(self, file_num, length):
+        ''' cuts the file down to length bytes, freeing the blocks past the end.
+        The rest of the new last block is zeroed, since growing the file again
+        exposes it.'''
+        extent_map = self.get_extent_map(file_num)
+        num_blocks = ceil(length / self.block_size)
+        shrunk = len(extent_map) > num_blocks
+        freed = extent_map.truncate(num_blocks)
+
+        if shrunk:
+            self.allocator.free(freed)
+            self.save_extent_map(file_num, extent_map)
+
+        tail = length % self.block_size
+        if tail:
+            last_block = extent_map.blocks(num_blocks - 1, 1)[0]
+            if last_block != NO_BLOCK:
+                self.update_block(last_block, tail, bytes(self.block_size - tail))
+
+        self.set_file_size(file_num, length)
+
+    def set_file_size(self, file_num, file_size):
+        self.update_fields(file_num, st_size=file_size)
+
+    ##### TIMESTAMPS #####
+
+    def set_times(self, file_num, **times):
+        ''' changes the file's timestamps, with its write lock held. Those
+        already set to the same second are skipped. With lazytime the rest
+        wait in memory for flush_times, otherwise they are written in the
+        current transaction, along with any access time a read recorded.'''
+        stat = self.get_file_description(file_num)
+        times = dict((name, value) for name, value in times.items() if stat[name] != value)
+        if not times:
+            return
+        if self.timestamps.lazytime:
+            self.timestamps.record(file_num, times)
+            return
+        pending = self.timestamps.pending(file_num)
+        pending.update(times)
+        with self.disk.transaction():
+            self.update_fields(file_num, **pending)
+        self.timestamps.written(file_num)
+
+    def flush_times(self):
+        ''' writes every file's pending timestamps in one transaction, holding
+        each file's lock while its metadata block is rewritten'''
+        with self.namespace_lock.reading():
+            files = self.timestamps.files()
+            if not files:
+                return
+            with self.disk.transaction():
+                for file_num in files:
+                    with self.file_lock(file_num).writing():
+                        times = self.timestamps.pending(file_num)
+                        if times:
+                            self.update_fields(file_num, **times)
+                        self.timestamps.written(file_num)
+
+    def flush_times_periodically(self):
+        while not self.stopping.wait(TIMESTAMP_FLUSH_SECONDS):
+            self.flush_times()
+
+    ##### INLINE DATA #####
+
+    def is_inline(self, file_num):
+        return METADATA.get(self.disk.view_block(file_num), 'flags') & INLINE_DATA
+
+    def write_inline(self, file_num, offset, data):
+        ''' writes data into the metadata block of a file which is inline or
+        empty, growing it if the data ends past the end. The metadata block is
+        journaled, so unlike data blocks the write is too.'''
+        block = self.disk.read_block(file_num)
+        flags = METADATA.get(block, 'flags')
+        if not flags & INLINE_DATA:
+            # clear any extents left from when the file had data blocks
+            block[INLINE_DATA_LOC:] = bytes(self.inline_size)
+        end = offset + len(data)
+        block[INLINE_DATA_LOC + offset:INLINE_DATA_LOC + end] = data
+        METADATA.set(block, 'flags', flags | INLINE_DATA)
+        METADATA.set(block, 'st_size', max(METADATA.get(block, 'st_size'), end))
+        self.disk.write_block(file_num, block)
+
+    def truncate_inline(self, file_num, length):
+        ''' cuts or extends the file to length bytes, which fit in its
+        metadata block, taking its data back inline if it was in data blocks'''
+        if self.is_inline(file_num):
+            block = self.disk.read_block(file_num)
+            # the bytes past the new end must read as zeros if it grows again
+            block[INLINE_DATA_LOC + length:] = bytes(self.inline_size - length)
+            METADATA.set(block, 'st_size', length)
+            if not length:
+                METADATA.set(block, 'flags', METADATA.get(block, 'flags') & ~INLINE_DATA)
+            self.disk.write_block(file_num, block)
+            return
+
+        data = self.read_file_range(file_num, 0, length)
+        self.shrink_file(file_num, 0)
+        self.write_inline(file_num, 0, data + bytes(length - len(data)))
+
+    def move_inline_data(self, file_num):
+        ''' moves the data of an inline file out to a data block, leaving the
+        metadata block free for extents. The block is allocated before the
+        inline data is cleared, so a full disk leaves the file as it was.'''
+        block_num = self.allocator.allocate()
+        block = self.disk.read_block(file_num)
+        file_size = METADATA.get(block, 'st_size')
+        data = bytes(block[INLINE_DATA_LOC:INLINE_DATA_LOC + file_size])
+        block[INLINE_DATA_LOC:] = bytes(self.inline_size)
+        METADATA.set(block, 'flags', METADATA.get(block, 'flags') & ~INLINE_DATA)
+        self.disk.write_block(file_num, block)
+
+        extent_map = self.get_extent_map(file_num)
+        extent_map.append([block_num])
+        self.save_extent_map(file_num, extent_map)
+        self.disk.write_blocks({block_num: data + bytes(self.block_size - file_size)})
+
+    ##### DIRECTORY ENTRIES #####
+
+    def get_directory(self, dir_num):
+        ''' returns the entries of the directory with metadata in block dir_num,
+        loading them the first time'''
+        self.forget_on_abort(dir_num)
+        directory = self.directories.get(dir_num)
+        if directory is None:
+            directory = self.load_directory(dir_num)
+            self.directories[dir_num] = directory
+        return directory
+
+    def load_directory(self, dir_num):
+        ''' reads every entry from the directory's data blocks'''
+        stat = STAT.unpack(self.disk.view_block(dir_num))
+        if not S_ISDIR(stat['st_mode']):
+            raise FuseOSError(ENOTDIR)
+
+        count = stat['st_size'] // DIRENT.size
+        block_nums = self.get_extent_map(dir_num).blocks()
+        data = memoryview(self.disk.read_blocks(block_nums))
+
+        entries = []
+        for i in range(len(block_nums)):
+            in_block = min(count - i * self.dirents_per_block, self.dirents_per_block)
+            block = data[i * self.block_size:(i + 1) * self.block_size]
+            entries.extend((bytes_to_pathname(name), file_num)
+                           for name, file_num in unpack_dirents(block, in_block))
+        return Directory(entries)
+
+    def add_entry(self, dir_num, name, file_num):
+        ''' adds an entry to the end of the directory'''
+        directory = self.get_directory(dir_num)
+        # the entry is written, and any block for it allocated, before the
+        # directory changes, so a full disk leaves the directory as it was
+        self.write_entry(dir_num, len(directory), name, file_num)
+        directory.add(name, file_num)
+        self.set_file_size(dir_num, len(directory) * DIRENT.size)
+
+    def remove_entry(self, dir_num, name):
+        ''' removes an entry, moving the last entry into its slot and freeing
+        the last block once no entries are left in it'''
+        directory = self.get_directory(dir_num)
+        slot, moved = directory.remove(name)
+        if moved is not None:
+            self.write_entry(dir_num, slot, moved, directory.get(moved))
+
+        extent_map = self.get_extent_map(dir_num)
+        freed = extent_map.truncate(ceil(len(directory) / self.dirents_per_block))
+        if freed:
+            self.allocator.free(freed)
+            self.save_extent_map(dir_num, extent_map)
+        self.set_file_size(dir_num, len(directory) * DIRENT.size)
+
+    def write_entry(self, dir_num, slot, name, file_num):
+        ''' writes entry slot of the directory, giving the directory a new
+        block when slot is the first entry in it. Entries are metadata, so
+        unlike file data they are journaled.'''
+        index, in_block = divmod(slot, self.dirents_per_block)
+        extent_map = self.get_extent_map(dir_num)
+        if index < len(extent_map):
+            block_num = extent_map.blocks(index, 1)[0]
+            block = self.disk.read_block(block_num)
+        else:
+            extent_map.append(self.allocator.allocate_blocks(1))
+            self.save_extent_map(dir_num, extent_map)
+            block_num = extent_map.blocks(index, 1)[0]
+            block = bytearray(self.block_size)
 
-    def truncate(self, path, length, fh=None):
-        self.write(path, None, 0, None, length)
+        DIRENT.pack_into(block, in_block * DIRENT.size, path_name_as_bytes(name), file_num)
+        self.disk.write_block(block_num, block)
 
     ##### UTIL METHODS #####
 
     def find_file_num(self, path):
-        ''' returns the block number of the metadata block for file with name path'''
-        _, file_num, _ = self.find_file_tuple(path)
+        ''' returns the block number of the metadata block for file with name path,
+        looking up one component at a time in the entries of each directory'''
+        file_num = self.root_loc
+        for name in path.split('/'):
+            if name:
+                file_num = self.get_directory(file_num).get(name)
+                if file_num is None:
+                    raise FuseOSError(ENOENT)
         return file_num
 
-    def find_file_tuple(self, path: str) -> Tuple[int, int, int]:
-        ''' finds the preceding (points to), current (points to), and next file 
-        for the file with name path'''
-        b_name_to_find = path_name_as_bytes(path)
-
-        block_num = ROOT_LOC
-        prev_block_num = ROOT_LOC
-
-        while True:
-            if block_num >= NUM_BLOCKS:
-                raise FuseOSError(ENOENT)
-
-            current_block = read_block(block_num)
-
-            start = NAME_LOC
-            end = NAME_LOC + NAME_SIZE
-
-            current_file_name = current_block[start:end]
-
-            if current_file_name == b_name_to_find:
-                return (prev_block_num, block_num, current_block[NEXT_FILE_LOC])
-            else:
-                prev_block_num = block_num
-                block_num = current_block[NEXT_FILE_LOC]
-
-    def find_last_file(self) -> int:
-        ''' fetches the block number of the last file in the file linked list'''
-        current_block_num = next_block_num = ROOT_LOC
-
-        while next_block_num < NUM_BLOCKS:
-            current_block_num = next_block_num
-            next_block_num = self.find_next_file(current_block_num)
-
-        return current_block_num
-
-    def find_next_file(self, current_file):
-        ''' retrieves the block number of the file pointed to by the current file'''
-        current_meta = read_block(current_file)
-        return current_meta[0]
+    def find_new_entry(self, path):
+        ''' returns the directory which is to hold path, and the name of the
+        entry, checking that it is free and fits in an entry'''
+        dir_path, name = self.split_path(path)
+        path_name_as_bytes(name)
+        dir_num = self.find_file_num(dir_path)
+        if name in self.get_directory(dir_num):
+            raise FuseOSError(EEXIST)
+        return dir_num, name
 
     def update_block(self, block_num: int, start: int, data: bytearray):
         ''' reads a whole block, overwrites data between start and len(data), and rewrites the 
         whole block back to memory'''
-        block_data = read_block(block_num)
+        block_data = self.disk.read_block(block_num)
         end = start + len(data)
 
-        block_data = block_data[:start] + data + block_data[end:]
+        block_data[start:end] = data
 
-        write_block(block_num, block_data)
+        # only data blocks are updated this way, so the write is not journaled
+        self.disk.write_blocks({block_num: block_data})
 
-    def convert_bytes_and_update_block(self, block_num: int, start: int, data: int, num_bytes: int):
-        ''' converts data to bytearray of size num_bytes, then updates the block with this data'''
-        data = int_to_bytes(data, num_bytes)
-        self.update_block(block_num, start, data)
+    def update_fields(self, block_num: int, record=METADATA, **values):
+        ''' reads a whole block, sets the named fields of the record in it, and
+        rewrites the whole block back to memory'''
+        block_data = self.disk.read_block(block_num)
+        for name, value in values.items():
+            record.set(block_data, name, value)
+        self.disk.write_block(block_num, block_data)
 
     def find_free_block(self):
-        ''' retrieves a free block from the front of the free block linked list. It then updates 
-        the root to point to the next free block, and returns the first free block'''
-        first_free_block_i = self.get_block(ROOT_LOC)
-        if first_free_block_i >= NUM_BLOCKS:
-            raise IOError("No free blocks remaining")
-
-        free_block = read_block(first_free_block_i)
-
-        next_free_block_i = free_block[NEXT_BLOCK_LOC]
-
-        self.convert_bytes_and_update_block(
-            ROOT_LOC, NEXT_BLOCK_LOC, next_free_block_i, NEXT_BLOCK_SIZE)
-
-        return first_free_block_i
-
-    def format_block(self, block_num):
-        ''' formats a block and inserts it at the front of the free block linked list.
-        This means the block now has no data written and points to no file, 
-        but points to the next free block '''
-        first_free_block = self.get_block(ROOT_LOC)
-        format_block(block_num, first_free_block)
+        ''' takes a free block from the bitmap allocator and returns its number'''
+        return self.allocator.allocate()
 
-        self.convert_bytes_and_update_block(
-            ROOT_LOC, NEXT_BLOCK_LOC, block_num, NEXT_BLOCK_SIZE)
+    def statfs(self, path):
+        free = self.allocator.free_count
+        return dict(f_bsize=self.block_size, f_frsize=self.block_size, f_blocks=self.num_blocks,
+                    f_bfree=free, f_bavail=free, f_namemax=NAME_SIZE)
 
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('mount')
+    parser.add_argument('--mmap', action='store_true',
+                        help='map the disk image into memory instead of using pread/pwrite')
+    parser.add_argument('--cache-size', type=int, default=CACHE_BLOCKS,
+                        help='number of blocks held in the write-back cache')
+    parser.add_argument('--io-threads', type=int, default=IO_THREADS,
+                        help='threads issuing the pieces of large reads and writes, 0 for none')
+    parser.add_argument('--atime', choices=Timestamps.MODES, default='relatime',
+                        help='when reads update the access time')
+    parser.add_argument('--lazytime', action='store_true',
+                        help='hold timestamp changes in memory and write them back in batches')
+    parser.add_argument('--log-every', type=int, default=0,
+                        help='log one in every N calls of each operation')
     args = parser.parse_args()
 
-    logging.basicConfig(level=logging.DEBUG)
-    fuse = FUSE(SmallDisk(), args.mount, foreground=True)
+    logging.basicConfig(level=logging.DEBUG if args.log_every else logging.WARNING)
+    backend = 'mmap' if args.mmap else 'pread'
+    fs = SmallDisk(backend=backend, cache_size=args.cache_size, io_threads=args.io_threads,
+                   atime=args.atime, lazytime=args.lazytime)
+    fs.log_every = args.log_every
+    fuse = FUSE(fs, args.mount, foreground=True)
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from codec import JOURNAL_HEADER
+from disktools import BlockDevice, Superblock, low_level_format
+from constants import *
+
+
+@pytest.fixture
+def image(tmp_path):
+    '''an image holding only a superblock and an empty journal, made without
+    format, which needs fuse'''
+    path = str(tmp_path / 'disk')
+    sb = Superblock(block_size=512, num_blocks=256)
+    low_level_format(sb.num_blocks, sb.block_size, path)
+    marker = bytearray(sb.block_size)
+    JOURNAL_HEADER.pack_into(marker, magic=JOURNAL_MAGIC, sequence=0, count=0, checksum=0)
+    with BlockDevice(path, superblock=sb) as disk:
+        disk.write_block(SUPERBLOCK_LOC, sb.pack())
+        disk.write_block(sb.journal_loc, marker)
+    return path
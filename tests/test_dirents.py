@@ -0,0 +1,24 @@
+from dirents import Directory
+
+
+def test_remove_moves_the_last_entry_into_the_slot():
+    directory = Directory([('a', 10), ('b', 11), ('c', 12)])
+    assert directory.remove('a') == (0, 'c')
+    assert directory.names == ['c', 'b']
+    assert directory.slots == {'c': 0, 'b': 1}
+    assert directory.get('c') == 12 and 'a' not in directory
+
+
+def test_remove_of_the_last_entry_moves_nothing():
+    directory = Directory([('a', 10), ('b', 11)])
+    assert directory.remove('b') == (1, None)
+    assert directory.names == ['a'] and directory.slots == {'a': 0}
+    assert directory.remove('a') == (0, None)
+    assert len(directory) == 0
+
+
+def test_add_after_remove_reuses_the_end():
+    directory = Directory([('a', 10), ('b', 11)])
+    directory.remove('a')
+    assert directory.add('c', 12) == 1
+    assert directory.names == ['b', 'c']
@@ -0,0 +1,45 @@
+from extents import ExtentMap, follows
+from constants import NO_BLOCK
+
+
+def test_follows():
+    assert follows([10, 2], [12, 1])
+    assert not follows([10, 2], [13, 1])
+    assert follows([NO_BLOCK, 2], [NO_BLOCK, 5])
+    assert not follows([NO_BLOCK, 2], [12, 1])
+    assert not follows([10, 2], [NO_BLOCK, 1])
+
+
+def test_split():
+    extent_map = ExtentMap([[10, 4], [NO_BLOCK, 4]])
+    assert extent_map.split(2) == 1
+    assert extent_map.extents == [[10, 2], [12, 2], [NO_BLOCK, 4]]
+    assert extent_map.split(6) == 3
+    assert extent_map.extents[2:] == [[NO_BLOCK, 2], [NO_BLOCK, 2]]
+    assert extent_map.logical_starts == [0, 2, 4, 6]
+    assert extent_map.split(4) == 2
+    assert extent_map.split(8) == 4
+
+
+def test_assign_fills_a_hole_and_merges():
+    extent_map = ExtentMap([[10, 2], [NO_BLOCK, 2], [14, 2]])
+    extent_map.assign(2, [12, 13])
+    assert extent_map.extents == [[10, 6]]
+    assert extent_map.logical_starts == [0]
+    assert len(extent_map) == 6
+
+
+def test_assign_inside_a_hole():
+    extent_map = ExtentMap([[NO_BLOCK, 6]])
+    extent_map.assign(2, [30, 31])
+    assert extent_map.extents == [[NO_BLOCK, 2], [30, 2], [NO_BLOCK, 2]]
+    assert extent_map.logical_starts == [0, 2, 4]
+    assert extent_map.blocks() == [NO_BLOCK, NO_BLOCK, 30, 31, NO_BLOCK, NO_BLOCK]
+
+
+def test_assign_past_the_end_leaves_a_hole():
+    extent_map = ExtentMap([[10, 1]])
+    extent_map.assign(3, [20, 21])
+    assert extent_map.extents == [[10, 1], [NO_BLOCK, 2], [20, 2]]
+    assert len(extent_map) == 5
+    assert extent_map.allocated_blocks() == [10, 20, 21]
@@ -0,0 +1,154 @@
+import pytest
+
+from cache import BlockCache
+from disktools import BlockDevice
+from journal import Journal
+
+
+def mount(path):
+    return Journal(BlockCache(BlockDevice(path), size=16))
+
+
+def crash(journal):
+    ''' drops the cache without writing anything back, as a crash would'''
+    journal.device.close()
+
+
+def write_uncommitted(journal, block_num, data):
+    ''' changes block_num as a transaction which has not committed yet does,
+    pinning it in the cache'''
+    journal.disk.pin([block_num])
+    journal.disk.write_block(block_num, data)
+
+
+def block(journal, fill):
+    return bytes([fill]) * journal.block_size
+
+
+def home(path, block_num):
+    with BlockDevice(path) as device:
+        return bytes(device.read_block(block_num))
+
+
+def test_crash_before_commit_loses_the_transaction(image):
+    journal = mount(image)
+    meta = journal.superblock.root_loc + 1
+    write_uncommitted(journal, meta, block(journal, 1))
+    crash(journal)
+
+    journal = mount(image)
+    assert journal.replayed == 0
+    assert bytes(journal.read_block(meta)) == block(journal, 0)
+    journal.close()
+
+
+def test_crash_after_commit_replays_the_transaction(image):
+    journal = mount(image)
+    meta = journal.superblock.root_loc + 1
+    with journal.transaction():
+        journal.write_block(meta, block(journal, 1))
+        journal.write_block(meta + 1, block(journal, 2))
+    crash(journal)
+    assert home(image, meta) == block(journal, 0)
+
+    journal = mount(image)
+    assert journal.replayed == 2
+    assert home(image, meta) == block(journal, 1)
+    assert home(image, meta + 1) == block(journal, 2)
+    journal.close()
+
+
+def test_torn_last_record_is_not_replayed(image):
+    journal = mount(image)
+    meta = journal.superblock.root_loc + 1
+    journal.write_block(meta, block(journal, 1))
+    journal.write_block(meta + 1, block(journal, 2))
+    # the second record is its header then its one image
+    torn = journal.loc + journal.head - 1
+    crash(journal)
+    with BlockDevice(image) as device:
+        device.write_block(torn, b'\xff' * 8)
+
+    journal = mount(image)
+    assert journal.replayed == 1
+    assert home(image, meta) == block(journal, 1)
+    assert home(image, meta + 1) == block(journal, 0)
+    journal.close()
+
+
+def test_journaled_block_reused_for_data_is_not_replayed(image):
+    journal = mount(image)
+    meta = journal.superblock.root_loc + 1
+    journal.write_block(meta, block(journal, 1))
+    # the block is freed and handed out again as a data block
+    journal.write_blocks({meta: block(journal, 7)})
+    journal.sync()
+    crash(journal)
+
+    journal = mount(image)
+    assert home(image, meta) == block(journal, 7)
+    journal.close()
+
+
+def test_pinned_block_survives_emptying_the_journal(image):
+    journal = mount(image)
+    meta = journal.superblock.root_loc + 1
+    reused = meta + 1
+    journal.write_block(meta, block(journal, 1))
+    journal.write_block(reused, block(journal, 2))
+
+    # an open transaction changes meta, then a data write to a block with an
+    # image in the journal empties it while meta is still pinned
+    write_uncommitted(journal, meta, block(journal, 3))
+    journal.write_blocks({reused: block(journal, 9)})
+    journal.sync()
+    crash(journal)
+
+    journal = mount(image)
+    assert home(image, meta) == block(journal, 1)
+    assert home(image, reused) == block(journal, 9)
+    journal.close()
+
+
+def test_failed_transaction_is_abandoned(image):
+    journal = mount(image)
+    meta = journal.superblock.root_loc + 1
+    journal.write_block(meta, block(journal, 1))
+    undone = []
+    with pytest.raises(OSError):
+        with journal.transaction():
+            journal.on_abort(lambda: undone.append('first'), key='first')
+            journal.on_abort(lambda: undone.append('again'), key='first')
+            journal.write_block(meta, block(journal, 2))
+            journal.write_block(meta + 1, block(journal, 3))
+            journal.on_abort(lambda: undone.append('second'))
+            journal.on_commit(lambda: undone.append('committed'))
+            raise OSError('disk full')
+
+    assert undone == ['second', 'first']
+    assert journal.aborts == 1
+    assert bytes(journal.read_block(meta)) == block(journal, 1)
+    assert bytes(journal.read_block(meta + 1)) == block(journal, 0)
+    assert not journal.disk.pinned
+    journal.sync()
+    crash(journal)
+
+    journal = mount(image)
+    assert journal.replayed == 1
+    assert home(image, meta) == block(journal, 1)
+    assert home(image, meta + 1) == block(journal, 0)
+    journal.close()
+
+
+def test_commit_callbacks_run_once_committed(image):
+    journal = mount(image)
+    meta = journal.superblock.root_loc + 1
+    done = []
+    with journal.transaction():
+        journal.write_block(meta, block(journal, 1))
+        journal.on_commit(lambda: done.append(meta in journal.journaled))
+        assert done == []
+    assert done == [True]
+    journal.on_commit(lambda: done.append('now'))
+    assert done == [True, 'now']
+    journal.close()
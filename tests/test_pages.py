@@ -0,0 +1,32 @@
+from pages import PAGE_SIZE, PagedFile
+
+
+def test_write_past_the_end_leaves_a_hole():
+    data = PagedFile(b'abc')
+    data.write(3 * PAGE_SIZE, b'xyz')
+    assert len(data) == 3 * PAGE_SIZE + 3
+    assert sorted(data.pages) == [0, 3]
+    assert data.read(0, 5) == b'abc\0\0'
+    assert data.read(3 * PAGE_SIZE - 1, 10) == b'\0xyz'
+
+
+def test_write_across_pages():
+    data = PagedFile()
+    payload = bytes(range(256)) * 10
+    data.write(PAGE_SIZE - 100, payload)
+    assert data.read(PAGE_SIZE - 100, len(payload)) == payload
+    assert sorted(data.pages) == [0, 1]
+
+
+def test_read_stops_at_the_end():
+    data = PagedFile(b'hello')
+    assert data.read(3, 100) == b'lo'
+    assert data.read(5, 10) == b''
+
+
+def test_truncate_drops_pages_and_zeroes_the_tail():
+    data = PagedFile(b'x' * (2 * PAGE_SIZE + 10))
+    data.truncate(10)
+    assert sorted(data.pages) == [0] and len(data) == 10
+    data.truncate(PAGE_SIZE)
+    assert data.read(0, PAGE_SIZE) == b'x' * 10 + bytes(PAGE_SIZE - 10)
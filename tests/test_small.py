@@ -0,0 +1,106 @@
+import pytest
+
+pytest.importorskip('fuse')
+
+from errno import ENOSPC
+
+from fuse import FuseOSError
+from format import format_disk
+from small import SmallDisk
+
+
+@pytest.fixture
+def disk(tmp_path):
+    path = str(tmp_path / 'disk')
+    format_disk(path, block_size=512, num_blocks=256)
+    fs = SmallDisk(path)
+    yield fs
+    fs.disk.close()
+
+
+def fill(fs, leave=0):
+    ''' writes a file until only leave blocks are free'''
+    fs.create('/fill', 0o644)
+    index = 0
+    while fs.allocator.free_count > leave:
+        try:
+            fs.write('/fill', b'F' * fs.block_size, index * fs.block_size, 0)
+        except FuseOSError:
+            break
+        index += 1
+
+
+def no_space(call, *args):
+    with pytest.raises(FuseOSError) as error:
+        call(*args)
+    assert error.value.errno == ENOSPC
+
+
+def test_create_without_space_for_its_entry(disk):
+    for i in range(disk.dirents_per_block - 1):
+        disk.create('/f%d' % i, 0o644)
+    fill(disk, leave=1)
+
+    no_space(disk.create, '/new', 0o644)
+    no_space(disk.mkdir, '/dir', 0o755)
+    assert 'new' not in disk.readdir('/')
+    assert 'dir' not in disk.readdir('/')
+
+
+def test_inline_file_kept_when_it_cannot_move_out(disk):
+    disk.create('/small', 0o644)
+    disk.write('/small', b'hello, world!', 0, 0)
+    fill(disk)
+
+    no_space(disk.write, '/small', b'more', 5000, 0)
+    no_space(disk.truncate, '/small', 5000)
+    assert disk.getattr('/small')['st_size'] == 13
+    assert disk.read('/small', 100, 0, 0) == b'hello, world!'
+
+
+def test_failed_write_is_rolled_back(disk, monkeypatch):
+    disk.create('/a', 0o644)
+    disk.write('/a', b'a' * 1000, 0, 0)
+    file_num = disk.find_file_num('/a')
+    free = disk.allocator.free_count
+    extents = [list(extent) for extent in disk.get_extent_map(file_num).extents]
+
+    def fail(*args):
+        raise FuseOSError(ENOSPC)
+    # the data blocks and extents are written, then the size update fails
+    monkeypatch.setattr(disk, 'set_file_size', fail)
+    no_space(disk.write, '/a', b'b' * 5000, 1000, 0)
+    monkeypatch.undo()
+
+    assert disk.allocator.free_count == free
+    assert disk.get_extent_map(file_num).extents == extents
+    assert disk.getattr('/a')['st_size'] == 1000
+    assert disk.read('/a', 10000, 0, 0) == b'a' * 1000
+
+
+def test_freed_blocks_wait_for_the_transaction_to_commit(disk):
+    disk.create('/a', 0o644)
+    disk.write('/a', b'a' * 5000, 0, 0)
+    blocks = disk.get_extent_map(disk.find_file_num('/a')).allocated_blocks()
+    free = disk.allocator.free_count
+
+    with disk.disk.transaction():
+        disk.allocator.free(blocks)
+        assert disk.allocator.free_count == free
+        assert not any(disk.allocator.is_free(block_num) for block_num in blocks)
+        assert not set(blocks) & set(disk.allocator.allocate_blocks(free - 1))
+    assert disk.allocator.free_count == len(blocks) + 1
+    assert all(disk.allocator.is_free(block_num) for block_num in blocks)
+
+
+def test_abandoned_transaction_frees_nothing(disk):
+    disk.create('/a', 0o644)
+    disk.write('/a', b'a' * 5000, 0, 0)
+    free = disk.allocator.free_count
+
+    with pytest.raises(FuseOSError):
+        with disk.disk.transaction():
+            disk.unlink('/a')
+            raise FuseOSError(ENOSPC)
+    assert disk.allocator.free_count == free
+    assert disk.read('/a', 10000, 0, 0) == b'a' * 5000
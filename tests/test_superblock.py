@@ -0,0 +1,28 @@
+import pytest
+
+from disktools import Superblock
+from constants import *
+
+
+def test_geometry_follows_the_superblock():
+    sb = Superblock(block_size=512, num_blocks=256)
+    assert sb.journal_loc == sb.bitmap_loc + sb.bitmap_blocks
+    assert sb.checkpoint_loc == sb.journal_loc + sb.journal_blocks
+    assert sb.root_loc == sb.checkpoint_loc + sb.checkpoint_blocks
+
+
+@pytest.mark.parametrize('block_size, num_blocks', [(128, 4), (4096, 3)])
+def test_too_few_blocks_for_the_root(block_size, num_blocks):
+    with pytest.raises(ValueError):
+        Superblock(block_size=block_size, num_blocks=num_blocks)
+
+
+@pytest.mark.parametrize('block_size, num_blocks', [(64, 64), (64, 1024), (4096, 64)])
+def test_journal_holds_two_records_of_the_minimum_size(block_size, num_blocks):
+    sb = Superblock(block_size=block_size, num_blocks=num_blocks)
+    assert sb.journal_blocks >= 1 + 2 * (1 + MIN_JOURNAL_RECORD_BLOCKS)
+
+
+def test_too_small_journal():
+    with pytest.raises(ValueError):
+        Superblock(block_size=64, num_blocks=1024, journal_blocks=4)
@@ -0,0 +1,47 @@
+import pytest
+
+from timestamps import Timestamps
+
+DAY = 24 * 60 * 60
+
+
+def stat(atime, mtime=100, ctime=100):
+    return dict(st_atime=atime, st_mtime=mtime, st_ctime=ctime)
+
+
+def test_noatime_never_updates():
+    assert not Timestamps('noatime').atime_due(stat(0), 10 * DAY)
+
+
+def test_strict_updates_unless_the_same_second():
+    timestamps = Timestamps('strict')
+    assert timestamps.atime_due(stat(200), 201)
+    assert not timestamps.atime_due(stat(201), 201)
+
+
+def test_relatime():
+    timestamps = Timestamps('relatime')
+    # not after the last modification or change
+    assert timestamps.atime_due(stat(100), 150)
+    assert timestamps.atime_due(stat(150, ctime=150), 160)
+    # after both, and recent
+    assert not timestamps.atime_due(stat(150), 160)
+    # after both, but a day old
+    assert timestamps.atime_due(stat(150), 150 + DAY)
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        Timestamps('sometimes')
+
+
+def test_changes_merge_until_written():
+    timestamps = Timestamps(lazytime=True)
+    timestamps.record(7, dict(st_atime=1))
+    timestamps.record(7, dict(st_atime=2, st_mtime=3))
+    assert timestamps.pending(7) == dict(st_atime=2, st_mtime=3)
+    assert timestamps.files() == [7]
+    timestamps.written(7)
+    assert timestamps.pending(7) == {}
+    stats = timestamps.stats()
+    assert (stats['recorded'], stats['merged'], stats['flushed']) == (2, 1, 1)
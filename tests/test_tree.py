@@ -0,0 +1,41 @@
+import pytest
+
+pytest.importorskip('fuse')
+
+from errno import ENOENT, ENOTDIR
+
+from fuse import FuseOSError
+from tree import Node, walk, walk_parent
+
+
+@pytest.fixture
+def root():
+    leaf = Node(dict(st_mode=0o100644), data=b'')
+    sub = Node(dict(st_mode=0o40755), children={'leaf': leaf})
+    return Node(dict(st_mode=0o40755), children={'sub': sub})
+
+
+def test_walk(root):
+    assert walk(root, '/') is root
+    assert walk(root, '/sub/leaf') is root.children['sub'].children['leaf']
+
+
+def test_walk_missing(root):
+    with pytest.raises(FuseOSError) as e:
+        walk(root, '/sub/nope')
+    assert e.value.errno == ENOENT
+
+
+def test_walk_through_a_file(root):
+    with pytest.raises(FuseOSError) as e:
+        walk(root, '/sub/leaf/x')
+    assert e.value.errno == ENOTDIR
+
+
+def test_walk_parent(root):
+    parent, name = walk_parent(root, '/sub/new')
+    assert parent is root.children['sub'] and name == 'new'
+    assert walk_parent(root, '/top') == (root, 'top')
+    with pytest.raises(FuseOSError) as e:
+        walk_parent(root, '/sub/leaf/x')
+    assert e.value.errno == ENOTDIR
@@ -0,0 +1,84 @@
+''' Access and modification time policy, with lazy write-back '''
+import threading
+
+from constants import RELATIME_SECONDS
+
+
+class Timestamps(object):
+    '''Decides whether a read changes a file's access time, and with
+    lazytime holds timestamp changes in memory until they are flushed.
+
+    atime is one of:
+        'strict':   every read sets the access time.
+        'relatime': a read sets it only if it is not after the last
+                    modification or change, or is over RELATIME_SECONDS old.
+        'noatime':  reads never set it.
+
+    Pending changes to the same file merge, so however many times a file is
+    touched between flushes its metadata block is written once. Access times
+    set by reads are always held here, even without lazytime, since a read
+    does not hold the lock needed to write the metadata block.
+    '''
+
+    MODES = ('strict', 'relatime', 'noatime')
+
+    def __init__(self, atime='relatime', lazytime=False, relatime_seconds=RELATIME_SECONDS):
+        if atime not in self.MODES:
+            raise ValueError('Unknown atime mode: ' + atime)
+        self.atime = atime
+        self.lazytime = lazytime
+        self.relatime_seconds = relatime_seconds
+        self.changes = dict()
+        self.lock = threading.Lock()
+
+        self.recorded = 0
+        self.merged = 0
+        self.flushed = 0
+
+    def atime_due(self, stat, now):
+        ''' returns whether a read at now should set the access time of the
+        file with stat'''
+        if self.atime == 'noatime':
+            return False
+        atime = stat['st_atime']
+        if self.atime == 'strict':
+            return atime != now
+        return atime <= stat['st_mtime'] or atime <= stat['st_ctime'] or \
+            now - atime >= self.relatime_seconds
+
+    def record(self, file_num, times):
+        ''' holds new timestamps for the file until it is flushed'''
+        with self.lock:
+            self.recorded += 1
+            pending = self.changes.get(file_num)
+            if pending is None:
+                self.changes[file_num] = dict(times)
+            else:
+                self.merged += 1
+                pending.update(times)
+
+    def pending(self, file_num):
+        ''' returns the timestamps held for the file, which override the
+        ones in its metadata block'''
+        with self.lock:
+            return dict(self.changes.get(file_num, ()))
+
+    def files(self):
+        with self.lock:
+            return sorted(self.changes)
+
+    def discard(self, file_num):
+        ''' forgets the file's pending timestamps, once they are written or
+        the file is removed'''
+        with self.lock:
+            self.changes.pop(file_num, None)
+
+    def written(self, file_num):
+        with self.lock:
+            if self.changes.pop(file_num, None) is not None:
+                self.flushed += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(atime=self.atime, lazytime=self.lazytime, pending=len(self.changes),
+                        recorded=self.recorded, merged=self.merged, flushed=self.flushed)
@@ -0,0 +1,42 @@
+''' Directory tree for the in-memory file systems '''
+from errno import ENOENT, ENOTDIR
+
+from fuse import FuseOSError
+
+
+class Node(object):
+    '''A file, directory or symlink. attrs is what getattr returns. Files
+    and symlinks keep their contents in data, and directories map the name
+    of each child to its node in children.'''
+    __slots__ = ('attrs', 'data', 'children')
+
+    def __init__(self, attrs, data=None, children=None):
+        self.attrs = attrs
+        self.data = data
+        self.children = children
+
+    def is_dir(self):
+        return self.children is not None
+
+
+def walk(root, path):
+    ''' returns the node at path, looking up one component at a time'''
+    node = root
+    for name in path.split('/'):
+        if not name:
+            continue
+        if node.children is None:
+            raise FuseOSError(ENOTDIR)
+        node = node.children.get(name)
+        if node is None:
+            raise FuseOSError(ENOENT)
+    return node
+
+
+def walk_parent(root, path):
+    ''' returns the directory node which holds path, and the name of path in it'''
+    dir_path, name = path.rsplit('/', 1)
+    parent = walk(root, dir_path)
+    if parent.children is None:
+        raise FuseOSError(ENOTDIR)
+    return parent, name